@@ -0,0 +1,137 @@
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+from metrics import process_cpu_seconds
+
+logger = logging.getLogger('admission')
+
+# Encoder settings applied as load rises, cheapest last. Each level trades
+# quality for CPU so admitted encodes stay at or above realtime.
+DEGRADE_LEVELS = [
+    {},
+    {'preset': 'superfast'},
+    {'preset': 'ultrafast', 'height': 720, 'maxrate': '2500k', 'bufsize': '5000k'},
+]
+
+
+class AdmissionController:
+    """Capacity-aware gate for concurrent live encodes.
+
+    At most ``max_encodes`` transcodes run at once; further requests wait in
+    a priority queue and are started as slots free up. Stream-copy jobs are
+    nearly free and bypass the limit. Without an explicit limit, capacity is
+    derived from the CPU count and the measured CPU cost of running encodes.
+    """
+
+    def __init__(self, max_encodes=None, cost_per_encode=1.0, headroom=0.9):
+        self.fixed_limit = max_encodes
+        self.cost_per_encode = cost_per_encode
+        self.headroom = headroom
+        self.cpu_count = os.cpu_count() or 1
+        self.active = {}
+        self.queue = []
+        self.queued = {}
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        # pid -> (time, CPU seconds) of its last cost sample
+        self.last_samples = {}
+
+    @property
+    def max_encodes(self):
+        """Current encode limit, fixed or derived from measured cost"""
+        if self.fixed_limit:
+            return self.fixed_limit
+        return max(1, int(self.cpu_count * self.headroom / self.cost_per_encode))
+
+    def request(self, stream_id, start, priority=0, copy=False):
+        """Admit a job now or queue it; returns 'admitted' or 'queued'
+
+        ``start(overrides, waited)`` is called with the encoder overrides to
+        apply and the seconds spent queued, either right away or later from
+        release() when the job leaves the queue.
+        """
+        with self.lock:
+            if copy or len(self.active) < self.max_encodes:
+                overrides = {} if copy else self._overrides_locked()
+                if not copy:
+                    self.active[stream_id] = time.time()
+                admitted = True
+            else:
+                entry = [-priority, next(self.counter), stream_id, start, time.time()]
+                heapq.heappush(self.queue, entry)
+                self.queued[stream_id] = entry
+                admitted = False
+
+        if admitted:
+            start(overrides, 0)
+            return 'admitted'
+        logger.info(f"Stream {stream_id} queued, {len(self.active)}/{self.max_encodes} encodes busy")
+        return 'queued'
+
+    def cancel(self, stream_id):
+        """Drop a queued job, returns True if it was waiting"""
+        with self.lock:
+            entry = self.queued.pop(stream_id, None)
+            if entry:
+                entry[3] = None
+            return entry is not None
+
+    def release(self, stream_id):
+        """Free an encode slot and start queued jobs that now fit"""
+        to_start = []
+        with self.lock:
+            self.active.pop(stream_id, None)
+            while self.queue and len(self.active) < self.max_encodes:
+                entry = heapq.heappop(self.queue)
+                _, _, queued_id, start, queued_at = entry
+                if start is None:
+                    continue
+                del self.queued[queued_id]
+                overrides = self._overrides_locked()
+                self.active[queued_id] = time.time()
+                to_start.append((start, overrides, time.time() - queued_at))
+
+        for start, overrides, waited in to_start:
+            start(overrides, waited)
+
+    def _overrides_locked(self):
+        """Pick encoder overrides from the load the new encode will add"""
+        load = len(self.active) / self.max_encodes
+        if load > 0.9:
+            return dict(DEGRADE_LEVELS[2])
+        if load > 0.6:
+            return dict(DEGRADE_LEVELS[1])
+        return dict(DEGRADE_LEVELS[0])
+
+    def sample_cost(self, pids):
+        """Update the per-encode CPU cost estimate from running ffmpeg PIDs
+
+        Reads utime+stime from /proc per process and averages the CPU cores
+        each one used since its previous sample, so samples taken while
+        encodes start and stop still compare. The estimate is an
+        exponentially weighted average. No-op where /proc is absent.
+        """
+        now = time.time()
+        rates = []
+        samples = {}
+        for pid in pids:
+            seconds = process_cpu_seconds(pid)
+            if seconds is None:
+                continue
+            last = self.last_samples.get(pid)
+            if last and now - last[0] >= 1 and seconds >= last[1]:
+                rates.append((seconds - last[1]) / (now - last[0]))
+                samples[pid] = (now, seconds)
+            else:
+                # New process, a reused PID or too close to the last sample
+                samples[pid] = last if last and seconds >= last[1] else (now, seconds)
+        # Exited processes drop out
+        self.last_samples = samples
+
+        cost = sum(rates) / len(rates) if rates else 0
+        if cost > 0:
+            self.cost_per_encode = 0.8 * self.cost_per_encode + 0.2 * cost
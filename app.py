@@ -1,11 +1,20 @@
 import streamlit as st
+import hashlib
 import os
-import json
-import datetime
-from datetime import datetime
-import time
-from streaming_engine import RTMPStreamer
-import threading
+from streaming_engine import FILL_POLICIES, RTMPStreamer, ReconnectPolicy
+from media_cache import MediaCache
+from media_probe import MediaProbe
+from admission import AdmissionController
+from schedule_store import ScheduleStore
+from schedule_runner import ScheduleRunner
+from control_client import ControlClient
+from encoder_profiles import profile_names
+from upload_store import UploadStore
+from resource_limits import ResourcePolicy
+from run_journal import RunJournal
+
+# Videos scheduled by their path on the server must be inside this directory
+MEDIA_DIR = os.environ.get('SCHEDULER_MEDIA_DIR', 'media')
 
 # Page config
 st.set_page_config(
@@ -14,11 +23,70 @@ st.set_page_config(
     layout="wide"
 )
 
+@st.cache_resource
+def get_backend():
+    """Build the engine and scheduler once per process, shared by every browser session
+
+    Streams keep running when a tab closes, and any number of open
+    dashboards share one timer thread and one engine.
+    """
+    daemon_url = os.environ.get('SCHEDULER_DAEMON_URL')
+    if daemon_url:
+        # Thin client: the headless daemon owns the engine and the schedule
+        return ControlClient(daemon_url), None
+
+    streamer = RTMPStreamer(
+        media_cache=MediaCache(),
+        admission=AdmissionController(),
+        reconnect=ReconnectPolicy(),
+        probe=MediaProbe(),
+        # Reniced ffmpeg children keep the dashboard responsive under load
+        resources=ResourcePolicy(),
+        # Live streams survive a restart of the Streamlit process
+        journal=RunJournal()
+    )
+    runner = ScheduleRunner(ScheduleStore(), streamer, preroll=10)
+    runner.start()
+    upload_store = UploadStore()
+    # Drop uploads left behind by interrupted sessions or slots that no longer air
+    upload_store.cleanup(keep=runner.referenced_paths())
+    return runner, upload_store
+
+
+backend, upload_store = get_backend()
+
 # Initialize session state
-if 'streams' not in st.session_state:
-    st.session_state.streams = []
-if 'streamer' not in st.session_state:
-    st.session_state.streamer = RTMPStreamer()
+if 'uploads' not in st.session_state:
+    st.session_state.uploads = {}
+
+
+def store_upload(uploaded_file):
+    """Save an uploaded video once and return its path, however often Streamlit reruns"""
+    key = getattr(uploaded_file, 'file_id', None) or f"{uploaded_file.name}|{uploaded_file.size}"
+    saved_path = st.session_state.uploads.get(key)
+    if saved_path:
+        return saved_path
+
+    uploaded_file.seek(0)
+    suffix = os.path.splitext(uploaded_file.name)[1] or '.mp4'
+    if isinstance(backend, ControlClient):
+        upload_id = hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+        saved_path = backend.upload(uploaded_file, upload_id, suffix)
+    else:
+        saved_path = upload_store.save_fileobj(uploaded_file, suffix)
+    st.session_state.uploads[key] = saved_path
+    return saved_path
+
+
+def resolve_server_path(path):
+    """Return the real path of a video inside MEDIA_DIR, None if it is outside it or not a file"""
+    media_dir = os.path.realpath(MEDIA_DIR)
+    # Relative paths are taken from the media directory; symlinks and '..' are resolved before the check
+    real_path = os.path.realpath(os.path.join(media_dir, path))
+    if os.path.commonpath([media_dir, real_path]) != media_dir or not os.path.isfile(real_path):
+        return None
+    return real_path
+
 
 # Title
 st.title("YouTube RTMP Live Streaming Scheduler")
@@ -30,15 +98,20 @@ with col1:
     st.subheader("Scheduled Streams")
     
     # Display current streams in a table
-    if st.session_state.streams:
+    streams = backend.list_streams()
+    if streams:
         streams_data = []
-        for stream in st.session_state.streams:
-            status = st.session_state.streamer.get_stream_status(stream['id']) or stream.get('status', 'Waiting')
+        for stream in streams:
+            live = stream.get('live')
+            status = live['status'] if live else stream.get('status', 'Waiting')
+            metrics = live['metrics'] if live else {}
             streams_data.append({
-                'Video': os.path.basename(stream['video_path']),
+                'Video': stream.get('video') or os.path.basename(stream['video_path']),
                 'Duration': stream['durasi'],
                 'Start Time': stream['jam_mulai'],
-                'Status': status
+                'Status': status,
+                'FPS': metrics.get('fps') or '-',
+                'Speed': f"{metrics['speed']:.2f}x" if metrics.get('speed') is not None else '-'
             })
         
         st.table(streams_data)
@@ -51,13 +124,21 @@ with col2:
     # File uploader
     uploaded_file = st.file_uploader("Choose a video file", type=['mp4'])
     
+    # Very large videos can be copied to the server and scheduled by path instead
+    server_path = st.text_input(f"...or path of a video already on the server, in {MEDIA_DIR}")
+    
+    video_path = None
     if uploaded_file:
-        # Save uploaded file temporarily
-        temp_path = os.path.join("temp", uploaded_file.name)
-        os.makedirs("temp", exist_ok=True)
-        with open(temp_path, "wb") as f:
-            f.write(uploaded_file.getbuffer())
-        
+        try:
+            video_path = store_upload(uploaded_file)
+        except (OSError, ValueError) as e:
+            st.error(f"Could not save upload: {e}")
+    elif server_path:
+        video_path = resolve_server_path(server_path)
+        if not video_path:
+            st.error(f"No video at {server_path} inside {MEDIA_DIR}")
+    
+    if video_path:
         # Time selection
         col_hour, col_minute = st.columns(2)
         with col_hour:
@@ -68,70 +149,51 @@ with col2:
         # Duration
         duration = st.text_input("Duration (HH:MM:SS)", value="01:00:00")
         
+        # Encoder profile, 'auto' matches the source and stream-copies when possible
+        profile = st.selectbox("Encoder profile", profile_names())
+        
+        # What covers the rest of the slot when the video is shorter than the duration
+        fill = st.selectbox("When the video ends early", FILL_POLICIES,
+                            format_func=lambda x: {'none': "End the stream", 'loop': "Loop the video",
+                                                   'filler': "Play the filler clip"}[x])
+        
         # Stream key
-        stream_key = st.text_input("YouTube Stream Key", type="password")
+        stream_key = st.text_input("YouTube Stream Key(s), comma-separated", type="password")
         
         if st.button("Schedule Stream"):
             if stream_key:
                 # Create new stream
-                stream_id = len(st.session_state.streams) + 1
                 stream = {
-                    "id": stream_id,
-                    "video_path": temp_path,
+                    # Uploads are stored under their content hash, keep the original name for display
+                    "video": uploaded_file.name if uploaded_file else os.path.basename(video_path),
+                    "video_path": video_path,
                     "durasi": duration,
                     "jam_mulai": f"{hour:02d}:{minute:02d}",
                     "streaming_key": stream_key,
-                    "status": "Waiting"
+                    "profile": profile,
+                    "fill": fill
                 }
                 
-                st.session_state.streams.append(stream)
-                st.success("Stream scheduled successfully!")
-                
-                # Note about FFmpeg
                 try:
-                    subprocess.run(['ffmpeg', '-version'], check=True, capture_output=True)
-                except:
+                    backend.add_stream(stream)
+                    st.success("Stream scheduled successfully!")
+                except ValueError as e:
+                    st.error(f"Could not schedule stream: {e}")
+                
+                # Note about FFmpeg; a daemon backend checks its own
+                if isinstance(backend, ScheduleRunner) and not backend.streamer.ffmpeg_available:
                     st.warning("FFmpeg is not available. Streams will run in simulation mode.")
             else:
                 st.error("Please enter a YouTube Stream Key")
 
-# Background stream checker
-def check_streams():
-    while True:
-        current_time = datetime.now()
-        current_time_str = f"{current_time.hour:02d}:{current_time.minute:02d}"
-        
-        for stream in st.session_state.streams:
-            if stream['jam_mulai'] == current_time_str and stream.get('status') == "Waiting":
-                # Parse duration
-                h, m, s = map(int, stream['durasi'].split(':'))
-                duration_seconds = h * 3600 + m * 60 + s
-                
-                # Start the stream
-                st.session_state.streamer.start_stream(
-                    stream['id'],
-                    stream['video_path'],
-                    stream['streaming_key'],
-                    duration_seconds
-                )
-                stream['status'] = "Live"
-        
-        time.sleep(30)
-
-# Start background checker in a separate thread
-if 'checker_thread' not in st.session_state:
-    checker_thread = threading.Thread(target=check_streams, daemon=True)
-    checker_thread.start()
-    st.session_state.checker_thread = checker_thread
-
 # Footer
 st.markdown("---")
 st.markdown("### Instructions")
 st.markdown("""
-1. Upload your video file (MP4 format)
+1. Upload your video file (MP4 format), or enter the path of a video already on the server
 2. Set the start time (hour and minute)
 3. Set the duration in HH:MM:SS format
-4. Enter your YouTube Stream Key
+4. Enter your YouTube Stream Key (several comma-separated keys or RTMP URLs are streamed from one encode)
 5. Click 'Schedule Stream' to add it to the schedule
 
 Note: This app requires FFmpeg for actual streaming. Without FFmpeg, it will run in simulation mode.
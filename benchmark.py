@@ -0,0 +1,254 @@
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import platform
+import subprocess
+import threading
+import time
+
+from encoder_profiles import profile_names
+from media_probe import MediaProbe
+from metrics import process_cpu_seconds
+from streaming_engine import DEFAULT_INGEST_URL, QUIT_GRACE, RTMPStreamer, ReconnectPolicy
+from timer_queue import TimerQueue
+
+logger = logging.getLogger('benchmark')
+
+
+def percentile(values, pct):
+    """Return the pct-th percentile of values (nearest rank), or None if empty"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return round(ordered[index], 4)
+
+
+def summarize(values):
+    """p50/p95/max of a list of measurements"""
+    return {'p50': percentile(values, 50), 'p95': percentile(values, 95),
+            'max': round(max(values), 4) if values else None}
+
+
+def process_rss_bytes(pid):
+    """Return the resident set size of a process, or 0 where /proc is absent"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def generate_test_video(path, duration, size='1280x720', rate=30):
+    """Render a synthetic H.264/AAC clip with lavfi testsrc and a sine tone"""
+    if os.path.exists(path):
+        return path
+    command = [
+        'ffmpeg', '-y', '-loglevel', 'error',
+        '-f', 'lavfi', '-i', f"testsrc=size={size}:rate={rate}",
+        '-f', 'lavfi', '-i', 'sine=frequency=1000:sample_rate=44100',
+        '-t', str(duration),
+        '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', '-g', str(rate * 2),
+        '-c:a', 'aac', '-b:a', '128k',
+        path
+    ]
+    subprocess.run(command, check=True)
+    return path
+
+
+class EventRecorder:
+    """In-memory stand-in for EventLog that the harness reads results from"""
+
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        """Keep one event"""
+        with self.lock:
+            self.records.append(dict(fields, event=event, ts=time.time()))
+
+    def take(self):
+        """Return and forget the recorded events"""
+        with self.lock:
+            records, self.records = self.records, []
+        return records
+
+
+class LocalSink:
+    """Local stand-in for an RTMP ingest: one ``ffmpeg -listen 1`` receiver per stream.
+
+    The receiver accepts a single publisher and discards what it gets, so
+    the benchmark measures the sending side without a real ingest server.
+    """
+
+    def __init__(self, port):
+        self.url = f"rtmp://127.0.0.1:{port}/live2/bench"
+        self.process = subprocess.Popen(
+            ['ffmpeg', '-loglevel', 'error', '-listen', '1', '-i', self.url, '-f', 'null', '-'],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL
+        )
+
+    def close(self):
+        """Stop the receiver"""
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+
+
+def run_level(streamer, recorder, timer, video_path, count, args):
+    """Run `count` concurrent streams for args.duration seconds and measure them"""
+    sinks = []
+    if args.ingest_url:
+        # A real server: one key per stream under the configured base URL
+        targets = [f"bench{index}" for index in range(count)]
+    else:
+        sinks = [LocalSink(args.base_port + index) for index in range(count)]
+        targets = [sink.url for sink in sinks]
+        # Give the receivers a moment to bind before the first connect
+        time.sleep(1.0)
+
+    done = threading.Event()
+    finished = []
+    finished_lock = threading.Lock()
+    jitter = []
+
+    def on_complete(stream_id, final=None):
+        with finished_lock:
+            finished.append(stream_id)
+            if len(finished) == count:
+                done.set()
+
+    def fire(stream_id, due):
+        jitter.append(time.time() - due)
+        started = streamer.start_stream(stream_id, video_path, targets[stream_id], args.duration, on_complete,
+                                        profile=args.profile, scheduled_at=due)
+        if not started:
+            on_complete(stream_id)
+
+    # All streams are due at the same instant, like a top-of-the-hour schedule
+    due = time.time() + 1.0
+    for stream_id in range(count):
+        timer.schedule(('bench', stream_id), due, fire, stream_id, due)
+
+    speeds = []
+    rss_peak = 0
+    cpu_start = {}
+    cpu_end = {}
+    while not done.wait(args.sample_interval):
+        rss = process_rss_bytes(os.getpid())
+        for stream_id, state in list(streamer.active_streams.items()):
+            speed = state.progress.latest().get('speed')
+            if speed is not None:
+                speeds.append(speed)
+            if state.process:
+                pid = state.process.pid
+                cpu = process_cpu_seconds(pid)
+                if cpu is not None:
+                    cpu_start.setdefault(pid, (time.time(), cpu))
+                    cpu_end[pid] = (time.time(), cpu)
+                rss += process_rss_bytes(pid)
+        rss_peak = max(rss_peak, rss)
+        if time.time() > due + args.duration + args.grace:
+            logger.warning(f"Level {count} overran, stopping remaining streams")
+            # Signalled all at once, then waited for so their stream_finished events are recorded
+            concurrent.futures.wait(streamer.stop_all().values(), timeout=2 * QUIT_GRACE + 1)
+            break
+
+    for sink in sinks:
+        sink.close()
+
+    events = recorder.take()
+    first_packets = [e for e in events if e['event'] == 'first_packet']
+    # Only the first packet of a stream counts as going live, later ones are reconnects
+    went_live = {}
+    for e in first_packets:
+        went_live.setdefault(e['stream_id'], e['since_scheduled'])
+    outcomes = [e['status'] for e in events if e['event'] == 'stream_finished']
+    failures = sum(1 for status in outcomes if status != 'completed') + (count - len(outcomes))
+
+    # Cores used per ffmpeg process over the window it was sampled
+    cpu_per_stream = [
+        (cpu_end[pid][1] - start_cpu) / (cpu_end[pid][0] - start_time)
+        for pid, (start_time, start_cpu) in cpu_start.items()
+        if cpu_end[pid][0] > start_time
+    ]
+    return {
+        'streams': count,
+        'schedule_to_live_s': summarize(list(went_live.values())),
+        'time_to_first_packet_s': summarize([e['after'] for e in first_packets]),
+        'scheduler_jitter_s': summarize(jitter),
+        'speed': {
+            'min': round(min(speeds), 3) if speeds else None,
+            'mean': round(sum(speeds) / len(speeds), 3) if speeds else None,
+            # Share of samples at realtime; below 1.0 the ingest starves
+            'realtime_ratio': round(sum(1 for s in speeds if s >= 0.98) / len(speeds), 3) if speeds else None
+        },
+        'cpu_cores_per_stream': summarize(cpu_per_stream),
+        'rss_peak_mb': round(rss_peak / 1024 ** 2, 1),
+        'rss_mb_per_stream': round(rss_peak / 1024 ** 2 / count, 1),
+        'reconnects': sum(1 for e in events if e['event'] == 'reconnecting'),
+        'failure_rate': round(failures / count, 3)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ramp concurrent RTMPStreamer streams and report capacity as JSON")
+    parser.add_argument('--ramp', default='1,2,4,8', help="Comma-separated concurrent stream counts to run")
+    parser.add_argument('--duration', type=int, default=30, help="Seconds each stream runs per level")
+    parser.add_argument('--grace', type=int, default=30, help="Extra seconds before a level is cut off")
+    parser.add_argument('--profile', default='720p', choices=profile_names(), help="Encoder profile under test")
+    parser.add_argument('--mode', default='async', choices=['thread', 'async'], help="Engine supervisor mode")
+    parser.add_argument('--ingest-url', default=None,
+                        help="RTMP base URL of a real test server (default: local ffmpeg -listen receivers)")
+    parser.add_argument('--base-port', type=int, default=19350, help="First port of the local receivers")
+    parser.add_argument('--video', default=os.path.join('bench', 'testsrc.mp4'), help="Test clip, generated if missing")
+    parser.add_argument('--sample-interval', type=float, default=1.0, help="Seconds between metric samples")
+    parser.add_argument('--output', default='benchmark_results.json', help="Where to write the JSON results")
+    args = parser.parse_args()
+
+    os.makedirs(os.path.dirname(args.video) or '.', exist_ok=True)
+    video_path = generate_test_video(args.video, args.duration + 10)
+
+    recorder = EventRecorder()
+    streamer = RTMPStreamer(
+        mode=args.mode,
+        reconnect=ReconnectPolicy(max_attempts=2),
+        probe=MediaProbe(os.path.join(os.path.dirname(args.video) or '.', 'probe_index.json')),
+        events=recorder,
+        ingest_url=args.ingest_url or DEFAULT_INGEST_URL
+    )
+    timer = TimerQueue()
+    timer.start()
+
+    results = {
+        'timestamp': time.time(),
+        'host': {'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+                 'ffmpeg': streamer.capabilities.version},
+        'config': {k: v for k, v in vars(args).items() if k != 'output'},
+        'levels': []
+    }
+    for count in [int(n) for n in args.ramp.split(',') if n.strip()]:
+        logger.info(f"Benchmark level: {count} concurrent streams")
+        level = run_level(streamer, recorder, timer, video_path, count, args)
+        results['levels'].append(level)
+        print(json.dumps(level))
+
+    timer.stop()
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import urllib.error
+import urllib.request
+
+# Chunks stay well under the daemon's request body limit
+UPLOAD_CHUNK_SIZE = 512 * 1024
+
+
+class ControlClient:
+    """Thin client for the daemon's control API.
+
+    Exposes the same add/cancel/list/status methods as ScheduleRunner so a UI
+    can drive either a local runner or a remote daemon.
+    """
+
+    def __init__(self, base_url='http://127.0.0.1:8765', timeout=10):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, method, path, payload=None, data=None, headers=None):
+        """Send one JSON (or raw `data`) request and return (status code, decoded body)"""
+        if payload is not None:
+            data = json.dumps(payload).encode('utf-8')
+        request = urllib.request.Request(
+            self.base_url + path,
+            data=data,
+            method=method,
+            headers=dict({'Content-Type': 'application/json'}, **(headers or {}))
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return response.status, json.loads(response.read() or b'null')
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read() or b'null')
+
+    def add_stream(self, stream):
+        """Schedule a slot on the daemon; returns its id"""
+        code, body = self._request('POST', '/streams', stream)
+        if code != 201:
+            raise ValueError(body.get('error', f"HTTP {code}"))
+        return body['id']
+
+    def cancel_stream(self, stream_id):
+        """Cancel a waiting slot or stop a live one"""
+        code, _ = self._request('DELETE', f"/streams/{stream_id}")
+        return code == 200
+
+    def stream_status(self, stream_id):
+        """Return one slot with its live status, or None"""
+        code, body = self._request('GET', f"/streams/{stream_id}")
+        return body if code == 200 else None
+
+    def list_streams(self):
+        """Return every slot with its live status"""
+        _, body = self._request('GET', '/streams')
+        return body or []
+
+    def health(self):
+        """Return the daemon's health report"""
+        _, body = self._request('GET', '/health')
+        return body
+
+    def upload(self, fileobj, upload_id, suffix='.mp4'):
+        """Upload a seekable file object in chunks, resuming where the daemon left off; returns the server path"""
+        code, body = self._request('GET', f"/uploads/{upload_id}")
+        if code != 200:
+            raise ValueError(body.get('error', f"HTTP {code}"))
+        offset = body['offset']
+        fileobj.seek(offset)
+
+        for chunk in iter(lambda: fileobj.read(UPLOAD_CHUNK_SIZE), b''):
+            code, body = self._request(
+                'PUT',
+                f"/uploads/{upload_id}",
+                data=chunk,
+                headers={'Content-Type': 'application/octet-stream', 'Upload-Offset': str(offset)}
+            )
+            if code == 409:
+                # The daemon has a different view of the upload; continue from its offset
+                offset = body['offset']
+                fileobj.seek(offset)
+                continue
+            if code != 200:
+                raise ValueError(body.get('error', f"HTTP {code}"))
+            offset = body['offset']
+
+        code, body = self._request('POST', f"/uploads/{upload_id}/finish", {'suffix': suffix})
+        if code != 201:
+            raise ValueError(body.get('error', f"HTTP {code}"))
+        return body['path']
+
+    def upload_file(self, video_path):
+        """Upload a local file; re-running after an interruption resumes it"""
+        st = os.stat(video_path)
+        # Same file, same id, so a retry picks up the partial upload
+        key = f"{os.path.abspath(video_path)}|{st.st_size}|{st.st_mtime_ns}"
+        upload_id = hashlib.sha256(key.encode('utf-8')).hexdigest()[:32]
+        with open(video_path, 'rb') as f:
+            return self.upload(f, upload_id, os.path.splitext(video_path)[1] or '.mp4')
@@ -0,0 +1,275 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import socket
+
+from admission import AdmissionController
+from media_cache import MediaCache
+from media_probe import MediaProbe
+from metrics import EventLog, MetricsRegistry
+from resource_limits import ResourcePolicy
+from run_journal import RunJournal
+from schedule_runner import ScheduleRunner
+from schedule_store import ScheduleStore
+from sharding import LEASE_SECONDS, ScheduleCoordinator, ScheduleWorker
+from streaming_engine import DEFAULT_INGEST_URL, RTMPStreamer, ReconnectPolicy, mask_rtmp_url
+from upload_store import UploadStore
+
+logger = logging.getLogger('daemon')
+
+STREAM_PATH = re.compile(r'^/streams/(\d+)$')
+UPLOAD_PATH = re.compile(r'^/uploads/([A-Za-z0-9_-]{1,64})(/finish)?$')
+MAX_BODY = 1024 * 1024
+
+REASONS = {200: 'OK', 201: 'Created', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 409: 'Conflict', 413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+def mask_key(key):
+    """Mask a bare stream key or the key part of an RTMP URL"""
+    key = key.strip()
+    if '://' in key:
+        return mask_rtmp_url(key)
+    return mask_rtmp_url('/' + key).lstrip('/')
+
+
+def public_stream(stream):
+    """Return a stream dict safe to send to clients (stream keys masked)"""
+    stream = dict(stream)
+    stream['streaming_key'] = ','.join(mask_key(key) for key in stream['streaming_key'].split(','))
+    return stream
+
+
+class ControlServer:
+    """Minimal asyncio HTTP/1.1 JSON API in front of a ScheduleRunner.
+
+    Routes:
+        GET    /health         liveness and active stream count
+        GET    /metrics        engine metrics in Prometheus text format
+        GET    /streams        every slot with live status
+        POST   /streams        add a slot, body is the stream JSON
+        GET    /streams/<id>   one slot with live status and metrics
+        DELETE /streams/<id>   cancel a waiting slot or stop a live one
+        GET    /uploads/<id>   bytes received so far, to resume an upload
+        PUT    /uploads/<id>   append a chunk (Upload-Offset header gives its position)
+        POST   /uploads/<id>/finish  store the upload, returns its server path
+    """
+
+    def __init__(self, runner, host='127.0.0.1', port=8765, uploads=None):
+        self.runner = runner
+        self.uploads = uploads
+        self.host = host
+        self.port = port
+
+    async def serve(self):
+        """Serve requests until cancelled"""
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        logger.info(f"Control API listening on http://{self.host}:{self.port}")
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        """Read one request, dispatch it and close the connection"""
+        try:
+            request_line = (await reader.readline()).decode('latin-1').strip()
+            method, path, _ = request_line.split(' ', 2)
+            headers = {}
+            while True:
+                line = (await reader.readline()).decode('latin-1').strip()
+                if not line:
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            length = int(headers.get('content-length', 0))
+            if length > MAX_BODY:
+                code, payload = 413, {'error': 'Request body too large'}
+            else:
+                body = await reader.readexactly(length) if length else b''
+                code, payload = await self.dispatch(method, path.split('?', 1)[0], body, headers)
+        except (ValueError, asyncio.IncompleteReadError) as e:
+            code, payload = 400, {'error': str(e)}
+        except Exception as e:
+            logger.error(f"Control API error: {str(e)}")
+            code, payload = 500, {'error': str(e)}
+
+        if isinstance(payload, str):
+            content_type = 'text/plain; version=0.0.4'
+            data = payload.encode('utf-8')
+        else:
+            content_type = 'application/json'
+            data = json.dumps(payload).encode('utf-8')
+        writer.write(
+            f"HTTP/1.1 {code} {REASONS.get(code, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            f"Connection: close\r\n\r\n".encode('latin-1') + data
+        )
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def call(self, func, *args):
+        """Run a blocking runner call (SQLite, process signals) in the default executor"""
+        return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    async def dispatch(self, method, path, body, headers=None):
+        """Route a request to the runner"""
+        if path == '/health':
+            active = self.runner.streamer.get_active_streams()
+            return 200, {'status': 'ok', 'active_streams': len(active)}
+
+        if path == '/workers':
+            # Sharded workers and their load, as last heartbeated to the shared store
+            return 200, await self.call(self.runner.store.workers)
+
+        if path == '/metrics':
+            # Collectors read /proc, keep them off the event loop
+            return 200, await self.call(self.runner.streamer.metrics.render)
+
+        if path == '/streams':
+            if method == 'GET':
+                streams = await self.call(self.runner.list_streams)
+                return 200, [public_stream(stream) for stream in streams]
+            if method == 'POST':
+                stream = json.loads(body or b'{}')
+                if not isinstance(stream, dict):
+                    return 400, {'error': "Stream must be a JSON object"}
+                try:
+                    stream_id = await self.call(self.runner.add_stream, stream)
+                except (KeyError, ValueError) as e:
+                    return 400, {'error': f"Invalid stream: {str(e)}"}
+                return 201, {'id': stream_id}
+            return 405, {'error': f"{method} not allowed on {path}"}
+
+        match = STREAM_PATH.match(path)
+        if match:
+            stream_id = int(match.group(1))
+            if method == 'GET':
+                stream = await self.call(self.runner.stream_status, stream_id)
+                if not stream:
+                    return 404, {'error': f"Stream {stream_id} not found"}
+                return 200, public_stream(stream)
+            if method == 'DELETE':
+                cancelled = await self.call(self.runner.cancel_stream, stream_id)
+                if not cancelled:
+                    return 404, {'error': f"Stream {stream_id} is not waiting or live"}
+                return 200, {'id': stream_id, 'status': 'Cancelled'}
+            return 405, {'error': f"{method} not allowed on {path}"}
+
+        match = UPLOAD_PATH.match(path)
+        if match and self.uploads:
+            return await self.dispatch_upload(method, match.group(1), bool(match.group(2)), body, headers or {})
+
+        return 404, {'error': f"No route for {path}"}
+
+    async def dispatch_upload(self, method, upload_id, finish, body, headers):
+        """Handle the resumable upload routes"""
+        if finish:
+            if method != 'POST':
+                return 405, {'error': f"{method} not allowed on finish"}
+            options = json.loads(body or b'{}')
+            suffix = options.get('suffix', '.mp4') if isinstance(options, dict) else '.mp4'
+            path = await self.call(self.uploads.finish, upload_id, suffix)
+            return 201, {'id': upload_id, 'path': path}
+
+        if method == 'GET':
+            return 200, {'id': upload_id, 'offset': self.uploads.offset(upload_id)}
+        if method == 'PUT':
+            offset = int(headers.get('upload-offset', 0))
+            try:
+                new_offset = await self.call(self.uploads.write_chunk, upload_id, offset, body)
+            except ValueError as e:
+                # Tell the client where to resume from
+                return 409, {'error': str(e), 'offset': self.uploads.offset(upload_id)}
+            return 200, {'id': upload_id, 'offset': new_offset}
+        return 405, {'error': f"{method} not allowed on uploads"}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless YouTube RTMP scheduler with a local JSON control API")
+    parser.add_argument('--host', default='127.0.0.1', help="Address to bind the control API to")
+    parser.add_argument('--port', type=int, default=8765, help="Port of the control API")
+    parser.add_argument('--db', default='streams.db', help="Schedule store path")
+    parser.add_argument('--upload-dir', default='uploads', help="Where uploaded videos are stored")
+    parser.add_argument('--events', default=None,
+                        help="JSON-lines event log, rotated at 10 MiB (default: events.jsonl, per worker id for workers)")
+    parser.add_argument('--journal', default=None,
+                        help="Run journal that lets a restarted daemon re-adopt or resume live streams "
+                             "(default: run_journal.json, per worker id for workers)")
+    parser.add_argument('--ingest-url', default=DEFAULT_INGEST_URL, help="RTMP base URL bare stream keys are sent to")
+    parser.add_argument('--max-encodes', type=int, default=None,
+                        help="Concurrent live encodes (default: derived from CPU count)")
+    parser.add_argument('--preroll', type=int, default=10,
+                        help="Seconds before a slot to connect and push a slate, so it goes live on time")
+    parser.add_argument('--filler', default=None,
+                        help="Clip chained after short videos of slots with fill=filler (default: black, silent video)")
+    parser.add_argument('--cores-per-stream', type=int, default=None,
+                        help="Pin each encode to this many of the least loaded cores (default: no pinning)")
+    parser.add_argument('--nice', type=int, default=10, help="Nice level of ffmpeg children")
+    parser.add_argument('--cgroup-root', default=None,
+                        help="Writable cgroup v2 directory for per-stream groups (optional)")
+    parser.add_argument('--cpu-max', type=float, default=None, help="Per-stream CPU limit in cores (needs --cgroup-root)")
+    parser.add_argument('--role', default='standalone', choices=['standalone', 'coordinator', 'worker'],
+                        help="standalone airs the whole schedule; a coordinator only accepts slots, "
+                             "which workers sharing --db claim and air")
+    parser.add_argument('--worker-id', default=None,
+                        help="Stable worker name, so a restarted worker keeps its slots (default: host-pid)")
+    parser.add_argument('--capacity', type=int, default=None,
+                        help="Streams a worker takes on at once (default: its encode limit)")
+    parser.add_argument('--lease', type=int, default=LEASE_SECONDS,
+                        help="Seconds without a heartbeat before a worker's slots are handed to others")
+    args = parser.parse_args()
+
+    worker_id = args.worker_id or f"{socket.gethostname()}-{os.getpid()}"
+    # Workers on one host must not share a journal or an event log
+    suffix = f"-{worker_id}" if args.role == 'worker' else ''
+    events_path = args.events or f"events{suffix}.jsonl"
+    journal_path = args.journal or f"run_journal{suffix}.json"
+
+    streamer = RTMPStreamer(
+        media_cache=MediaCache(),
+        mode='async',
+        admission=AdmissionController(max_encodes=args.max_encodes),
+        reconnect=ReconnectPolicy(),
+        probe=MediaProbe(),
+        metrics=MetricsRegistry(),
+        events=EventLog(events_path),
+        ingest_url=args.ingest_url,
+        filler_path=args.filler,
+        # A coordinator airs nothing, so it has nothing to recover
+        journal=RunJournal(journal_path) if args.role != 'coordinator' else None,
+        resources=ResourcePolicy(
+            cores_per_stream=args.cores_per_stream,
+            nice=args.nice,
+            cgroup_root=args.cgroup_root,
+            cpu_max=args.cpu_max
+        )
+    )
+    store = ScheduleStore(args.db)
+    if args.role == 'worker':
+        runner = ScheduleWorker(store, streamer, worker_id=worker_id, capacity=args.capacity, lease=args.lease,
+                                preroll=args.preroll)
+    elif args.role == 'coordinator':
+        runner = ScheduleCoordinator(store, streamer, preroll=args.preroll)
+    else:
+        runner = ScheduleRunner(store, streamer, preroll=args.preroll)
+    runner.start()
+
+    # Drop uploads left behind by interrupted transfers or slots that no longer air
+    uploads = UploadStore(args.upload_dir)
+    if args.role != 'worker':
+        uploads.cleanup(keep=runner.referenced_paths())
+
+    try:
+        asyncio.run(ControlServer(runner, args.host, args.port, uploads).serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+import logging
+
+from media_probe import can_stream_copy
+
+logger = logging.getLogger('encoder_profiles')
+
+# YouTube's recommended video bitrates (kbps) per output height and frame rate class
+PROFILES = {
+    '1080p': {'height': 1080, 'max_fps': 60, 'kbps': {30: 4500, 60: 6000}, 'audio': '160k'},
+    '720p': {'height': 720, 'max_fps': 60, 'kbps': {30: 2500, 60: 4000}, 'audio': '160k'},
+    '480p': {'height': 480, 'max_fps': 30, 'kbps': {30: 1000}, 'audio': '128k'},
+    '360p': {'height': 360, 'max_fps': 30, 'kbps': {30: 700}, 'audio': '128k'},
+}
+
+# Rungs 'auto' picks from, largest first
+LADDER = ['1080p', '720p', '480p', '360p']
+
+DEFAULT_FPS = 30
+
+
+def profile_names():
+    """Names accepted by plan_encode(), for UIs"""
+    return ['auto', 'copy'] + LADDER
+
+
+def pick_rung(info):
+    """Return the largest ladder rung that does not upscale the source"""
+    height = (info or {}).get('height')
+    if not height:
+        return LADDER[0]
+    for name in LADDER:
+        if PROFILES[name]['height'] <= height:
+            return name
+    return LADDER[-1]
+
+
+def plan_encode(profile='auto', info=None):
+    """Resolve a named profile against probed source properties.
+
+    Returns the encoder settings understood by RTMPStreamer._build_command
+    plus what the encode involves: 'copy' (no encode at all), 'scale'
+    (resize needed) and 'convert_fps' (frame rate conversion needed).
+    'auto' stream-copies compliant sources and otherwise picks the ladder
+    rung matching the source; 'copy' falls back to 'auto' when the source
+    cannot be copied.
+    """
+    info = info or {}
+    profile = profile or 'auto'
+
+    if profile in ('auto', 'copy'):
+        if can_stream_copy(info):
+            return {'name': profile, 'copy': True, 'scale': False, 'convert_fps': False}
+        if profile == 'copy':
+            logger.warning("Source cannot be stream-copied, falling back to the 'auto' profile")
+        name = pick_rung(info)
+        # Without probe data, auto keeps the source size instead of guessing
+        scale_unknown = False
+    elif profile in PROFILES:
+        name = profile
+        scale_unknown = True
+    else:
+        raise ValueError(f"Unknown encoder profile: {profile}")
+
+    spec = PROFILES[name]
+    source_height = info.get('height')
+    source_fps = info.get('fps')
+
+    # Scale down only, never up
+    if source_height:
+        height = spec['height'] if source_height > spec['height'] else None
+    else:
+        height = spec['height'] if scale_unknown else None
+    out_height = height or source_height or spec['height']
+
+    fps = None
+    if source_fps and source_fps > spec['max_fps'] + 0.01:
+        fps = spec['max_fps']
+    elif source_fps and info.get('vfr'):
+        # Resample variable frame rate sources to a constant rate
+        fps = round(source_fps)
+    out_fps = fps or source_fps or DEFAULT_FPS
+
+    kbps = spec['kbps'][60 if out_fps > 31 and 60 in spec['kbps'] else 30]
+    if out_height < spec['height']:
+        # Smaller than the rung (no upscaling): budget by pixel count
+        kbps = int(kbps * (out_height / spec['height']) ** 2)
+    source_kbps = (info.get('video_bitrate') or info.get('bitrate') or 0) // 1000
+    if source_kbps:
+        # Spending more bits than the source has buys no quality
+        kbps = min(kbps, int(source_kbps * 1.2))
+    kbps = max(kbps, 500)
+
+    return {
+        'name': name,
+        'copy': False,
+        'scale': height is not None,
+        'convert_fps': fps is not None,
+        'height': height,
+        'fps': fps,
+        # Keyframe every 2 s as YouTube expects
+        'gop': max(1, round(out_fps * 2)),
+        'maxrate': f"{kbps}k",
+        'bufsize': f"{kbps * 2}k",
+        'audio_bitrate': spec['audio']
+    }
@@ -0,0 +1,180 @@
+import json
+import logging
+import os
+import shutil
+import subprocess
+import threading
+
+logger = logging.getLogger('ffmpeg_caps')
+
+CAPS_CACHE = 'ffmpeg_caps.json'
+
+# Shared per (binary, cache) so every engine in a process discovers at most once
+_instances = {}
+_instances_lock = threading.Lock()
+
+
+def ffmpeg_capabilities(binary='ffmpeg', cache_path=CAPS_CACHE):
+    """Return the process-wide FFmpegCapabilities of a binary"""
+    with _instances_lock:
+        key = (binary, os.path.abspath(cache_path))
+        if key not in _instances:
+            _instances[key] = FFmpegCapabilities(binary, cache_path)
+        return _instances[key]
+
+
+def _parse_listing(output, separator):
+    """Names from an -encoders/-muxers listing: rows of "<flags> <name>[,<name>] <description>" after the separator"""
+    names = set()
+    started = False
+    for line in output.splitlines():
+        if not started:
+            started = line.strip().startswith(separator)
+            continue
+        fields = line.split()
+        if len(fields) >= 2:
+            names.update(fields[1].split(','))
+    return sorted(names)
+
+
+def _parse_protocols(output):
+    """Input and output protocol names from an -protocols listing"""
+    protocols = {'input': [], 'output': []}
+    section = None
+    for line in output.splitlines():
+        heading = line.strip().rstrip(':').lower()
+        if heading in protocols:
+            section = heading
+        elif section and line.strip():
+            protocols[section].append(line.strip())
+    return protocols
+
+
+class FFmpegCapabilities:
+    """What the installed ffmpeg supports, discovered once and cached on disk.
+
+    The cache is keyed by the binary's resolved path and mtime, so an
+    upgrade or a different ffmpeg on PATH is re-probed while every other
+    start is a stat and a JSON read instead of four forks. It records the
+    version line plus the encoders, muxers and protocols the engine relies
+    on choosing between.
+    """
+
+    def __init__(self, binary='ffmpeg', cache_path=CAPS_CACHE):
+        self.binary = binary
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        self.caps = None
+        self.key = None
+
+    def _key(self):
+        """Cache key of the binary currently on PATH, None if there is none"""
+        path = shutil.which(self.binary)
+        if not path:
+            return None
+        path = os.path.realpath(path)
+        return f"{path}|{os.stat(path).st_mtime_ns}"
+
+    def discover(self):
+        """Return the capabilities of the binary, probing it only on a cache miss; None if it cannot run"""
+        try:
+            key = self._key()
+        except OSError as e:
+            logger.error(f"Cannot stat {self.binary}: {str(e)}")
+            key = None
+        if key is None:
+            return None
+
+        with self.lock:
+            if key == self.key:
+                return self.caps
+
+            cache = self._load()
+            caps = cache.get(key)
+            if caps is None:
+                caps = self._probe()
+                if caps is None:
+                    return None
+                # Only the current binary is worth keeping
+                self._save({key: caps})
+                logger.info(f"Discovered {caps['version']}")
+            self.key, self.caps = key, caps
+            return caps
+
+    def _load(self):
+        """Read the on-disk cache, empty if missing or unreadable"""
+        try:
+            if os.path.exists(self.cache_path):
+                with open(self.cache_path, 'r') as f:
+                    return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Cannot load ffmpeg capability cache {self.cache_path}: {str(e)}")
+        return {}
+
+    def _save(self, cache):
+        """Atomically write the cache to disk"""
+        temp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(cache, f)
+            os.replace(temp_path, self.cache_path)
+        except OSError as e:
+            logger.error(f"Cannot save ffmpeg capability cache: {str(e)}")
+
+    def _run(self, *args):
+        """Stdout of the binary run with args"""
+        return subprocess.run(
+            [self.binary, '-hide_banner', *args],
+            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True
+        ).stdout
+
+    def _probe(self):
+        """Ask the binary for its version, encoders, muxers and protocols"""
+        try:
+            version = subprocess.run(
+                [self.binary, '-version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True
+            ).stdout.split('\n')[0]
+        except (subprocess.SubprocessError, OSError) as e:
+            logger.error(f"FFmpeg check failed: {str(e)}")
+            return None
+
+        caps = {'version': version, 'encoders': [], 'muxers': [], 'protocols': {'input': [], 'output': []}}
+        try:
+            caps['encoders'] = _parse_listing(self._run('-encoders'), '------')
+            caps['muxers'] = _parse_listing(self._run('-muxers'), '--')
+            caps['protocols'] = _parse_protocols(self._run('-protocols'))
+        except (subprocess.SubprocessError, OSError) as e:
+            # An ffmpeg that runs but cannot list is still usable, supports() then assumes yes
+            logger.error(f"Cannot list ffmpeg capabilities: {str(e)}")
+        return caps
+
+    @property
+    def available(self):
+        """True if the binary runs"""
+        return self.discover() is not None
+
+    @property
+    def version(self):
+        """The binary's version line, or None"""
+        caps = self.discover()
+        return caps['version'] if caps else None
+
+    def supports(self, kind, name):
+        """True if the binary has an 'encoder', 'muxer' or (output) 'protocol' of that name"""
+        caps = self.discover()
+        if not caps:
+            return False
+        names = caps['protocols']['output'] if kind == 'protocol' else caps[f"{kind}s"]
+        # An empty list means it could not be listed, not that nothing is there
+        return not names or name in names
+
+    def missing(self, copy=False, outputs=()):
+        """What a stream with these outputs needs from the binary but does not get, e.g. ['muxer tee']"""
+        needs = [('muxer', 'flv')]
+        if not copy:
+            needs += [('encoder', 'libx264'), ('encoder', 'aac')]
+        if len(outputs) > 1:
+            needs.append(('muxer', 'tee'))
+        for url in outputs:
+            needs.append(('protocol', url.split(':', 1)[0]))
+        return [f"{kind} {name}" for kind, name in dict.fromkeys(needs) if not self.supports(kind, name)]
@@ -0,0 +1,100 @@
+import re
+import threading
+import time
+from collections import deque
+
+# ffmpeg -progress emits bare "key=value" lines; anything else is log output
+PROGRESS_LINE = re.compile(r'^([a-z0-9_]+)=(.*)$')
+# Logged by the tee muxer when one destination drops out under onfail=ignore
+TEE_SLAVE_FAILED = re.compile(r'Slave muxer #(\d+) failed')
+
+
+class ProgressTracker:
+    """Incremental parser for ffmpeg ``-progress`` output.
+
+    Lines are fed one at a time as they are drained from the process. Every
+    ``progress=`` line closes a block, which is turned into a metrics sample
+    and appended to a fixed-size ring buffer. Non-progress lines are kept in
+    a short log tail so failures can be reported without storing the full
+    stderr.
+    """
+
+    def __init__(self, history=120, log_lines=20, on_first_sample=None):
+        self.block = {}
+        # Called once with the first sample, i.e. when ffmpeg starts producing output
+        self.on_first_sample = on_first_sample
+        self.samples = deque(maxlen=history)
+        self.log_tail = deque(maxlen=log_lines)
+        self.failed_slaves = set()
+        self.lock = threading.Lock()
+
+    def feed_line(self, line):
+        """Consume one line of ffmpeg output"""
+        line = line.strip()
+        if not line:
+            return
+
+        match = PROGRESS_LINE.match(line)
+        if not match:
+            failed = TEE_SLAVE_FAILED.search(line)
+            with self.lock:
+                self.log_tail.append(line)
+                if failed:
+                    self.failed_slaves.add(int(failed.group(1)))
+            return
+
+        key, value = match.groups()
+        self.block[key] = value.strip()
+        if key == 'progress':
+            sample = self._parse_block(self.block)
+            self.block = {}
+            with self.lock:
+                first = not self.samples
+                self.samples.append(sample)
+            if first and self.on_first_sample:
+                self.on_first_sample(sample)
+
+    def _parse_block(self, block):
+        """Turn one raw progress block into a metrics sample"""
+        def number(key, suffix=''):
+            value = block.get(key, '')
+            if suffix and value.endswith(suffix):
+                value = value[:-len(suffix)]
+            try:
+                return float(value)
+            except ValueError:
+                return None
+
+        out_time_us = number('out_time_us')
+        return {
+            'timestamp': time.time(),
+            'frame': number('frame'),
+            'fps': number('fps'),
+            'bitrate_kbps': number('bitrate', 'kbits/s'),
+            'speed': number('speed', 'x'),
+            'dup_frames': number('dup_frames'),
+            'drop_frames': number('drop_frames'),
+            'total_size': number('total_size'),
+            'out_time': out_time_us / 1e6 if out_time_us is not None else None,
+            'progress': block.get('progress')
+        }
+
+    def latest(self):
+        """Return the most recent metrics sample, or an empty dict"""
+        with self.lock:
+            return dict(self.samples[-1]) if self.samples else {}
+
+    def history(self):
+        """Return a copy of the buffered metrics samples, oldest first"""
+        with self.lock:
+            return list(self.samples)
+
+    def failed_outputs(self):
+        """Return the indexes of tee outputs that have failed"""
+        with self.lock:
+            return set(self.failed_slaves)
+
+    def last_log_lines(self):
+        """Return the tail of non-progress ffmpeg output"""
+        with self.lock:
+            return list(self.log_tail)
@@ -0,0 +1,204 @@
+import concurrent.futures
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import threading
+
+logger = logging.getLogger('media_cache')
+
+# Files are hashed in 1 MiB blocks so multi-GB videos never sit in memory
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Where content digests are persisted, inside the cache directory
+DIGEST_INDEX = 'digests.json'
+
+
+class MediaCache:
+    """Content-addressed on-disk cache of pre-encoded FLV/H.264 mezzanine files.
+
+    Each source video is transcoded once, ahead of its slot, into a file that
+    satisfies the FLV/RTMP constraints (H.264 + AAC, fixed GOP, yuv420p) so
+    the streaming engine can push it with ``-c copy`` at air time.
+
+    Pre-encodes run on a small pool of workers at the lowest CPU and I/O
+    priority, so they only use what live encodes leave idle. Content
+    digests are persisted keyed by (path, size, mtime) like MediaProbe's
+    index, so a restart does not hash every source again.
+    """
+
+    def __init__(self, cache_dir='cache', max_bytes=50 * 1024 ** 3, workers=1):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                              thread_name_prefix='media-cache')
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.index_path = os.path.join(cache_dir, DIGEST_INDEX)
+        self.digests = {}
+        try:
+            if os.path.exists(self.index_path):
+                with open(self.index_path, 'r') as f:
+                    self.digests = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Cannot load digest index {self.index_path}: {str(e)}")
+
+        # Wrappers that start the transcode at idle priority, where the platform has them
+        self.idle_prefix = []
+        if shutil.which('nice'):
+            self.idle_prefix += ['nice', '-n', '19']
+        if shutil.which('ionice'):
+            self.idle_prefix += ['ionice', '-c', '3']
+
+    def content_hash(self, video_path):
+        """Return the SHA-256 digest of a file, memoised on disk by (path, size, mtime)"""
+        st = os.stat(video_path)
+        key = f"{os.path.abspath(video_path)}|{st.st_size}|{st.st_mtime_ns}"
+        with self.lock:
+            digest = self.digests.get(key)
+        if digest:
+            return digest
+
+        sha = hashlib.sha256()
+        with open(video_path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+
+        with self.lock:
+            # Forget older versions of the same file
+            prefix = key.rsplit('|', 2)[0] + '|'
+            for stale in [k for k in self.digests if k.startswith(prefix)]:
+                del self.digests[stale]
+            self.digests[key] = digest
+            self._save_locked()
+        return digest
+
+    def _save_locked(self):
+        """Atomically write the digest index to disk"""
+        temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(self.digests, f)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            logger.error(f"Cannot save digest index: {str(e)}")
+
+    def path_for(self, digest):
+        """Return the cache path for a content digest"""
+        return os.path.join(self.cache_dir, f"{digest}.flv")
+
+    def lookup(self, video_path):
+        """Return the cached mezzanine path for a video, or None on a miss"""
+        try:
+            cached_path = self.path_for(self.content_hash(video_path))
+        except OSError as e:
+            logger.error(f"Cannot hash {video_path}: {str(e)}")
+            return None
+
+        if os.path.exists(cached_path):
+            # Bump the access time so LRU eviction keeps recently aired files
+            os.utime(cached_path)
+            return cached_path
+        return None
+
+    def build_command(self, video_path, output_path):
+        """Build the one-off transcode command producing a stream-copyable FLV"""
+        return [
+            'ffmpeg',
+            '-y',
+            '-i', video_path,
+            '-c:v', 'libx264',
+            '-preset', 'medium',  # Offline encode, spend CPU once for quality
+            '-maxrate', '4500k',
+            '-bufsize', '9000k',
+            '-pix_fmt', 'yuv420p',
+            '-g', '60',
+            '-keyint_min', '60',
+            '-sc_threshold', '0',  # Fixed GOP so copy-mode keyframes stay regular
+            '-c:a', 'aac',
+            '-b:a', '160k',
+            '-ac', '2',
+            '-ar', '44100',
+            '-f', 'flv',
+            output_path
+        ]
+
+    def prepare(self, video_path):
+        """Transcode a video into the cache if needed and return the cached path"""
+        cached_path = self.lookup(video_path)
+        if cached_path:
+            return cached_path
+
+        digest = self.content_hash(video_path)
+        cached_path = self.path_for(digest)
+        temp_path = cached_path + '.part'
+
+        logger.info(f"Pre-encoding {video_path} into {cached_path}")
+        try:
+            subprocess.run(
+                self.idle_prefix + self.build_command(video_path, temp_path),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                check=True
+            )
+            os.replace(temp_path, cached_path)
+        except (subprocess.SubprocessError, OSError) as e:
+            logger.error(f"Pre-encode failed for {video_path}: {str(e)}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return None
+
+        self.evict()
+        return cached_path
+
+    def prepare_async(self, video_path, on_ready=None):
+        """Queue a background pre-encode and return its future; duplicate requests are coalesced"""
+        key = os.path.abspath(video_path)
+        with self.lock:
+            if key in self.pending:
+                return self.pending[key]
+            future = self.executor.submit(self._prepare_job, key, video_path, on_ready)
+            self.pending[key] = future
+        return future
+
+    def _prepare_job(self, key, video_path, on_ready):
+        """Worker job wrapping prepare() for prepare_async()"""
+        try:
+            cached_path = self.prepare(video_path)
+            if on_ready:
+                on_ready(video_path, cached_path)
+            return cached_path
+        finally:
+            with self.lock:
+                self.pending.pop(key, None)
+
+    def evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.flv'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+                logger.info(f"Evicted {path} from media cache")
+            except OSError as e:
+                logger.error(f"Failed to evict {path}: {str(e)}")
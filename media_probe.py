@@ -0,0 +1,184 @@
+import json
+import logging
+import os
+import subprocess
+import threading
+
+logger = logging.getLogger('media_probe')
+
+# Longest keyframe interval YouTube accepts; beyond this the source must be re-encoded
+MAX_KEYFRAME_INTERVAL = 4.0
+
+# Stream parameters the concat demuxer takes from a playlist's first file for all of them
+CONCAT_LAYOUT = ('video_codec', 'pix_fmt', 'width', 'height', 'audio_codec', 'audio_sample_rate', 'audio_channels')
+
+
+def parse_rate(rate):
+    """Convert an ffprobe rate such as "30000/1001" to a float"""
+    try:
+        num, _, den = rate.partition('/')
+        return float(num) / float(den or 1)
+    except (AttributeError, ValueError, ZeroDivisionError):
+        return None
+
+
+class MediaProbe:
+    """ffprobe metadata index, cached on disk and keyed by (path, size, mtime).
+
+    A file is probed once; later lookups are a dict hit until the file
+    changes. The index records duration, codecs, resolution, frame rate,
+    keyframe interval and bitrate, which is enough to validate a slot and to
+    decide between stream copy and transcode.
+    """
+
+    def __init__(self, index_path='probe_index.json'):
+        self.index_path = index_path
+        self.lock = threading.Lock()
+        self.index = {}
+        try:
+            if os.path.exists(index_path):
+                with open(index_path, 'r') as f:
+                    self.index = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Cannot load probe index {index_path}: {str(e)}")
+
+    def _key(self, video_path):
+        """Index key for a file, changes whenever the file does"""
+        st = os.stat(video_path)
+        return f"{os.path.abspath(video_path)}|{st.st_size}|{st.st_mtime_ns}"
+
+    def probe(self, video_path):
+        """Return metadata for a video, probing it only on an index miss; None if unreadable"""
+        try:
+            key = self._key(video_path)
+        except OSError as e:
+            logger.error(f"Cannot stat {video_path}: {str(e)}")
+            return None
+
+        with self.lock:
+            if key in self.index:
+                return dict(self.index[key])
+
+        info = self._run_ffprobe(video_path)
+        if info is None:
+            return None
+
+        with self.lock:
+            # Forget older versions of the same file
+            prefix = key.rsplit('|', 2)[0] + '|'
+            for stale in [k for k in self.index if k.startswith(prefix)]:
+                del self.index[stale]
+            self.index[key] = info
+            self._save_locked()
+        return dict(info)
+
+    def _save_locked(self):
+        """Atomically write the index to disk"""
+        temp_path = f"{self.index_path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump(self.index, f)
+            os.replace(temp_path, self.index_path)
+        except OSError as e:
+            logger.error(f"Cannot save probe index: {str(e)}")
+
+    def _run_ffprobe(self, video_path):
+        """Run ffprobe on a file and reduce its output to the fields we use"""
+        try:
+            result = subprocess.run(
+                ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', video_path],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True
+            )
+            data = json.loads(result.stdout)
+        except (subprocess.SubprocessError, FileNotFoundError, ValueError) as e:
+            logger.error(f"ffprobe failed for {video_path}: {str(e)}")
+            return None
+
+        fmt = data.get('format', {})
+        video = next((s for s in data.get('streams', []) if s.get('codec_type') == 'video'), None)
+        audio = next((s for s in data.get('streams', []) if s.get('codec_type') == 'audio'), None)
+
+        info = {
+            'duration': float(fmt.get('duration') or 0) or None,
+            'format': fmt.get('format_name'),
+            'bitrate': int(fmt['bit_rate']) if fmt.get('bit_rate') else None,
+            'video_codec': None,
+            'audio_codec': None
+        }
+        if video:
+            avg_fps = parse_rate(video.get('avg_frame_rate'))
+            real_fps = parse_rate(video.get('r_frame_rate'))
+            info.update({
+                'video_codec': video.get('codec_name'),
+                'pix_fmt': video.get('pix_fmt'),
+                'width': video.get('width'),
+                'height': video.get('height'),
+                'fps': avg_fps or real_fps,
+                # avg and nominal rate disagree on variable frame rate sources
+                'vfr': bool(avg_fps and real_fps and abs(avg_fps - real_fps) > 0.01),
+                'video_bitrate': int(video['bit_rate']) if video.get('bit_rate') else None,
+                'keyframe_interval': self._keyframe_interval(video_path)
+            })
+        if audio:
+            info.update({
+                'audio_codec': audio.get('codec_name'),
+                'audio_sample_rate': int(audio['sample_rate']) if audio.get('sample_rate') else None,
+                'audio_channels': audio.get('channels')
+            })
+        return info
+
+    def _keyframe_interval(self, video_path, window=30):
+        """Average seconds between keyframes over the first `window` seconds"""
+        try:
+            result = subprocess.run(
+                ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-skip_frame', 'nokey',
+                 '-read_intervals', f"%+{window}", '-show_entries', 'frame=pts_time',
+                 '-of', 'csv=p=0', video_path],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, check=True
+            )
+        except (subprocess.SubprocessError, FileNotFoundError):
+            return None
+
+        times = sorted(float(t) for t in result.stdout.split() if t.replace('.', '', 1).isdigit())
+        if len(times) < 2:
+            return None
+        return round((times[-1] - times[0]) / (len(times) - 1), 3)
+
+
+def can_stream_copy(info):
+    """True if a probed source can be pushed to RTMP/FLV without re-encoding"""
+    if not info or info.get('video_codec') != 'h264' or info.get('pix_fmt') != 'yuv420p':
+        return False
+    if info.get('audio_codec') not in ('aac', None):
+        return False
+    if info.get('vfr'):
+        return False
+    interval = info.get('keyframe_interval')
+    return interval is not None and interval <= MAX_KEYFRAME_INTERVAL
+
+
+def same_layout(first, other):
+    """True if other can follow first inside one concat demuxer input, decoded as the same stream"""
+    if not first or not other:
+        return False
+    if any(first.get(key) != other.get(key) for key in CONCAT_LAYOUT):
+        return False
+    return bool(first.get('fps') and other.get('fps') and abs(first['fps'] - other['fps']) < 0.01)
+
+
+def validate_slot(info, duration):
+    """Return (errors, warnings) for airing a probed video in a slot of `duration` seconds"""
+    errors = []
+    warnings = []
+    if not info:
+        errors.append("File could not be read by ffprobe")
+        return errors, warnings
+    if not info.get('video_codec'):
+        errors.append("File has no video stream")
+    if not info.get('audio_codec'):
+        warnings.append("File has no audio stream")
+    if info.get('duration') and info['duration'] < duration:
+        warnings.append(f"Video is {info['duration']:.0f}s long but the slot is {duration}s")
+    if info.get('vfr'):
+        warnings.append("Variable frame rate source, it will be re-encoded at a constant rate")
+    return errors, warnings
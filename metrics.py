@@ -0,0 +1,202 @@
+import json
+import logging
+import logging.handlers
+import os
+import threading
+import time
+
+logger = logging.getLogger('metrics')
+
+# Seconds; covers sub-second connects up to slots that start minutes late
+DEFAULT_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def process_cpu_seconds(pid):
+    """Return the user+system CPU seconds a process has used, or None where /proc is absent"""
+    ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / ticks
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def _format_labels(names, values):
+    """Render a label set as {a="x",b="y"}"""
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class _Metric:
+    """Base of the metric families; one value per label combination"""
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        """Map keyword labels to the tuple values are stored under"""
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"{self.name} expects labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def render(self):
+        """Return the exposition lines of this family"""
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.label_names, key)} {value}")
+        return lines
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Add amount to the count of a label combination"""
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Value that can go up and down"""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        """Set the value of a label combination"""
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def clear(self):
+        """Forget every label combination, e.g. before re-collecting per-stream values"""
+        with self.lock:
+            self.values.clear()
+
+
+class Histogram(_Metric):
+    """Distribution of observations in cumulative buckets"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """Record one observation"""
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            counts[-1] += 1
+            self.values[key] = (counts, total + value)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        names = self.label_names + ('le',)
+        with self.lock:
+            for key, (counts, total) in sorted(self.values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_format_labels(names, key + (bound,))} {count}")
+                lines.append(f"{self.name}_bucket{_format_labels(names, key + ('+Inf',))} {counts[-1]}")
+                lines.append(f"{self.name}_sum{_format_labels(self.label_names, key)} {total}")
+                lines.append(f"{self.name}_count{_format_labels(self.label_names, key)} {counts[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """Set of metric families rendered in the Prometheus text exposition format.
+
+    Collectors are callables run on every scrape, for values that are cheaper
+    to read on demand (per-stream speed and CPU) than to keep updated.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def _register(self, metric):
+        """Add a family, or return the one already registered under its name"""
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing:
+                # Several engines in one process share the family
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labels=()):
+        """Create or fetch a counter"""
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name, documentation, labels=()):
+        """Create or fetch a gauge"""
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        """Create or fetch a histogram"""
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def add_collector(self, collector):
+        """Run collector() before every render"""
+        with self.lock:
+            self.collectors.append(collector)
+
+    def render(self):
+        """Return every metric in Prometheus text format"""
+        with self.lock:
+            collectors = list(self.collectors)
+            metrics = [self.metrics[name] for name in sorted(self.metrics)]
+        for collector in collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.error(f"Metrics collector failed: {str(e)}")
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+class EventLog:
+    """Structured JSON-lines event log with size-based rotation.
+
+    One object per line with a timestamp and an event name, so the log can
+    be shipped and aggregated across hosts.
+    """
+
+    def __init__(self, path='events.jsonl', max_bytes=10 * 1024 * 1024, backup_count=5):
+        self.path = path
+        self.logger = logging.getLogger(f'events.{os.path.abspath(path)}')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+        if not self.logger.handlers:
+            handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger.addHandler(handler)
+
+    def emit(self, event, **fields):
+        """Append one event"""
+        record = {'ts': round(time.time(), 3), 'event': event}
+        record.update(fields)
+        self.logger.info(json.dumps(record, default=str))
@@ -0,0 +1,132 @@
+import logging
+import os
+import shutil
+import subprocess
+import threading
+
+logger = logging.getLogger('resource_limits')
+
+# cpu.max period in microseconds
+CGROUP_PERIOD = 100000
+
+
+def available_cores():
+    """Return the CPUs this process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class ResourcePolicy:
+    """Per-stream CPU placement, scheduling priority and optional cgroup v2 limits.
+
+    Streams are spread evenly: each one is pinned to the least loaded cores
+    not reserved for the UI. ffmpeg children are reniced and given a
+    best-effort I/O class so the UI and the scheduler stay responsive, and
+    the encoder's thread pool is capped to the cores it was given. When a
+    writable cgroup v2 directory is configured every stream also gets its own
+    child group with cpu.max / memory.max. Anything the platform does not
+    support is skipped with a log line.
+    """
+
+    def __init__(self, cores_per_stream=None, reserve_cores=1, nice=10, ionice_class=2, ionice_level=7,
+                 threads=None, cgroup_root=None, cpu_max=None, memory_max=None):
+        self.cores_per_stream = cores_per_stream
+        self.nice = nice
+        self.ionice_class = ionice_class
+        self.ionice_level = ionice_level
+        self.threads = threads
+        self.cgroup_root = cgroup_root
+        self.cpu_max = cpu_max
+        self.memory_max = memory_max
+        self.lock = threading.Lock()
+        self.placements = {}
+
+        cores = available_cores()
+        # Keep the first cores for the UI and the engine itself, but never all of them
+        self.cores = cores[reserve_cores:] if len(cores) > reserve_cores else cores
+        self.load = dict.fromkeys(self.cores, 0)
+        self.ionice = shutil.which('ionice') if ionice_class is not None else None
+
+        if cgroup_root and not os.path.exists(os.path.join(cgroup_root, 'cgroup.controllers')):
+            logger.warning(f"{cgroup_root} is not a cgroup v2 directory, cgroup limits disabled")
+            self.cgroup_root = None
+
+    def place(self, stream_id, copy=False):
+        """Reserve cores for a stream and return them (empty when pinning is off)"""
+        if not self.cores_per_stream:
+            return []
+        # Stream copy barely uses a core, one is plenty
+        count = 1 if copy else min(self.cores_per_stream, len(self.cores))
+        with self.lock:
+            if stream_id in self.placements:
+                return self.placements[stream_id]
+            cores = sorted(self.cores, key=lambda core: (self.load[core], core))[:count]
+            for core in cores:
+                self.load[core] += 1
+            self.placements[stream_id] = cores
+        return cores
+
+    def threads_for(self, cores):
+        """Encoder thread cap for a stream pinned to cores"""
+        return self.threads or len(cores) or None
+
+    def apply(self, stream_id, pid):
+        """Apply the stream's placement and limits to a freshly spawned ffmpeg"""
+        cores = self.placements.get(stream_id)
+        if cores and hasattr(os, 'sched_setaffinity'):
+            try:
+                os.sched_setaffinity(pid, cores)
+            except OSError as e:
+                logger.error(f"Cannot pin stream {stream_id} to cores {cores}: {str(e)}")
+
+        if self.nice and hasattr(os, 'setpriority'):
+            try:
+                os.setpriority(os.PRIO_PROCESS, pid, self.nice)
+            except OSError as e:
+                logger.error(f"Cannot renice stream {stream_id}: {str(e)}")
+
+        if self.ionice:
+            # No ioprio_set() in the standard library, util-linux does it for us
+            subprocess.run(
+                [self.ionice, '-c', str(self.ionice_class), '-n', str(self.ionice_level), '-p', str(pid)],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+            )
+
+        if self.cgroup_root:
+            self._apply_cgroup(stream_id, pid)
+
+    def _cgroup_path(self, stream_id):
+        """Directory of a stream's cgroup"""
+        return os.path.join(self.cgroup_root, f"stream-{stream_id}")
+
+    def _apply_cgroup(self, stream_id, pid):
+        """Move pid into the stream's own cgroup, creating it with its limits"""
+        path = self._cgroup_path(stream_id)
+        try:
+            if not os.path.isdir(path):
+                os.mkdir(path)
+                if self.cpu_max:
+                    # cpu_max is in cores, e.g. 1.5 allows 150 ms of CPU per 100 ms
+                    with open(os.path.join(path, 'cpu.max'), 'w') as f:
+                        f.write(f"{int(self.cpu_max * CGROUP_PERIOD)} {CGROUP_PERIOD}")
+                if self.memory_max:
+                    with open(os.path.join(path, 'memory.max'), 'w') as f:
+                        f.write(str(self.memory_max))
+            with open(os.path.join(path, 'cgroup.procs'), 'w') as f:
+                f.write(str(pid))
+        except OSError as e:
+            logger.error(f"Cannot apply cgroup limits to stream {stream_id}: {str(e)}")
+
+    def release(self, stream_id):
+        """Give back a finished stream's cores and remove its cgroup"""
+        with self.lock:
+            for core in self.placements.pop(stream_id, []):
+                self.load[core] -= 1
+
+        if self.cgroup_root and os.path.isdir(self._cgroup_path(stream_id)):
+            try:
+                # Only empty groups can be removed; the last ffmpeg has exited by now
+                os.rmdir(self._cgroup_path(stream_id))
+            except OSError as e:
+                logger.error(f"Cannot remove cgroup of stream {stream_id}: {str(e)}")
@@ -0,0 +1,139 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import threading
+
+logger = logging.getLogger('run_journal')
+
+# The log is compacted once it holds this many times more lines than live entries (plus a floor)
+COMPACT_FACTOR = 4
+COMPACT_MIN = 64
+
+
+class RunJournal:
+    """Crash-safe record of the streams an engine is running.
+
+    Per stream the journal holds what a restarted engine needs to pick it
+    up again: the ffmpeg pid, the content offset and start time of the
+    current attempt, the slot deadline and the resolved options. Every
+    change is one JSON line appended and fsynced by a writer thread, so a
+    change costs O(1) and never blocks the caller on the disk. Once the log
+    is mostly superseded lines it is compacted into a single snapshot line
+    through a temporary file and an atomic rename. A line torn by a crash
+    is skipped on load. heartbeat() touches the file; its mtime at load
+    time tells roughly when the previous engine went away.
+    """
+
+    def __init__(self, path='run_journal.json'):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries, self.lines = self._load()
+        # When the previous engine was last alive, None on a fresh journal
+        self.last_seen = os.path.getmtime(path) if os.path.exists(path) else None
+        # Serialised lines waiting for the writer thread
+        self.pending = queue.Queue()
+        threading.Thread(target=self._writer, daemon=True).start()
+        # Streams outlive the engine, so what they were journaled as must reach the disk at exit
+        atexit.register(self.flush)
+
+    def _load(self):
+        """Replay the journal from disk; returns the entries and the number of lines read"""
+        entries = {}
+        try:
+            with open(self.path) as f:
+                lines = f.read().splitlines()
+        except FileNotFoundError:
+            return entries, 0
+        except OSError as e:
+            logger.error(f"Cannot read run journal {self.path}: {str(e)}")
+            return entries, 0
+
+        for number, line in enumerate(lines, 1):
+            try:
+                change = json.loads(line)
+            except ValueError:
+                if number < len(lines):
+                    logger.error(f"Skipping unreadable line {number} of run journal {self.path}")
+                continue
+            if 'stream_id' not in change:
+                # A snapshot, written by compaction or by older versions as the whole journal
+                entries = change
+            elif change.get('removed'):
+                entries.pop(str(change['stream_id']), None)
+            else:
+                entries.setdefault(str(change['stream_id']), {}).update(change)
+        return entries, len(lines)
+
+    def _writer(self):
+        """Thread function appending queued changes to the journal"""
+        while True:
+            line = self.pending.get()
+            try:
+                self._append(line)
+            finally:
+                self.pending.task_done()
+
+    def _append(self, line):
+        """Append one change to the journal and compact it when it has grown stale"""
+        try:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+        except OSError as e:
+            logger.error(f"Cannot write run journal {self.path}: {str(e)}")
+            return
+        self.lines += 1
+        if self.lines > COMPACT_FACTOR * len(self.entries) + COMPACT_MIN:
+            self._compact()
+
+    def _compact(self):
+        """Atomically replace the journal with a snapshot of its entries"""
+        # Changes still queued were already applied to the snapshot, replaying them after it is harmless
+        with self.lock:
+            snapshot = json.dumps(self.entries, default=str)
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                f.write(snapshot + '\n')
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+            self.lines = 1
+        except OSError as e:
+            logger.error(f"Cannot compact run journal {self.path}: {str(e)}")
+
+    def record(self, stream_id, **fields):
+        """Create or update the entry of a stream"""
+        with self.lock:
+            # JSON object keys are strings, the id itself is kept in the entry
+            entry = self.entries.setdefault(str(stream_id), {'stream_id': stream_id})
+            entry.update(fields)
+            # Serialised now, the options dict keeps changing after this
+            self.pending.put(json.dumps(dict(fields, stream_id=stream_id), default=str))
+
+    def remove(self, stream_id):
+        """Forget a stream that has left the engine"""
+        with self.lock:
+            if self.entries.pop(str(stream_id), None) is not None:
+                self.pending.put(json.dumps({'stream_id': stream_id, 'removed': True}))
+
+    def flush(self):
+        """Wait until every change so far is on disk"""
+        self.pending.join()
+
+    def snapshot(self):
+        """Return a copy of every entry"""
+        with self.lock:
+            return copy.deepcopy(list(self.entries.values()))
+
+    def heartbeat(self):
+        """Mark the engine as alive now"""
+        try:
+            os.utime(self.path)
+        except OSError:
+            # Nothing journaled yet
+            pass
@@ -0,0 +1,258 @@
+import logging
+import os
+from datetime import datetime, timedelta
+
+from encoder_profiles import profile_names
+from media_probe import same_layout, validate_slot
+from streaming_engine import FILL_POLICIES
+from timer_queue import TimerQueue, next_occurrence
+
+logger = logging.getLogger('schedule_runner')
+
+# Stored status of a slot by the final engine status of the stream that aired it
+SLOT_STATUS = {'completed': "Completed", 'error': "Error", 'stopped': "Cancelled"}
+
+
+def parse_duration(durasi):
+    """Convert an "HH:MM:SS" duration into seconds"""
+    h, m, s = map(int, durasi.split(':'))
+    return h * 3600 + m * 60 + s
+
+
+class ScheduleRunner:
+    """Drives a ScheduleStore: arms start timers and airs due slots on an RTMPStreamer.
+
+    This is the one place that owns scheduling decisions, shared by the
+    Streamlit app and the headless daemon. Status values follow the app's
+    vocabulary: Waiting, Live, Completed, Error, Cancelled.
+    """
+
+    def __init__(self, store, streamer, timer=None, preroll=0):
+        self.store = store
+        self.streamer = streamer
+        self.timer = timer or TimerQueue()
+        # Seconds before jam_mulai a slot is started, pushing a slate until it is due
+        self.preroll = preroll
+
+    def start(self):
+        """Start the timer thread, recover slots left live and re-arm every waiting one"""
+        self.timer.start()
+        self.recover()
+        for stream in self.store.by_status("Waiting"):
+            self.arm(stream)
+
+    def recover(self):
+        """Reconcile slots a previous run left Live with the engine's run journal
+
+        Streams the engine re-adopts or resumes stay Live and complete as
+        usual; any other Live slot was interrupted for good and becomes Error.
+        """
+        recovered = self.streamer.recover(lambda tag: self.completer(tag or []))
+        airing = {slot_id for tag in recovered.values() for slot_id in (tag or [])}
+        for stream in self.store.by_status("Live"):
+            if stream['id'] not in airing and stream['id'] not in recovered:
+                logger.warning(f"Stream {stream['id']} was interrupted by a restart")
+                self.store.transition(stream['id'], "Live", "Error")
+
+    def completer(self, slot_ids):
+        """Return the on_complete callback recording how the stream airing these slots ended
+
+        Slots of a playlist before the item on air at the end aired in full
+        and are Completed, the one on air takes the stream's outcome, and the
+        ones never reached go back to Waiting to air on their own.
+        """
+        def on_complete(_, final):
+            current = final.get('playlist_index', len(slot_ids) - 1)
+            for index, slot_id in enumerate(slot_ids):
+                if index < current:
+                    status = "Completed"
+                elif index == current:
+                    status = SLOT_STATUS.get(final['status'], "Error")
+                else:
+                    status = "Waiting"
+                self.settle_slot(slot_id, status)
+        return on_complete
+
+    def settle_slot(self, slot_id, status):
+        """Move a slot off Live once its stream has ended, re-arming it if it never aired"""
+        if self.store.transition(slot_id, "Live", status) and status == "Waiting":
+            self.arm(self.store.get(slot_id))
+
+    def arm(self, stream):
+        """Arm the start timer of one waiting slot"""
+        when = next_occurrence(stream['jam_mulai']) - timedelta(seconds=self.preroll)
+        self.timer.schedule(stream['id'], when, self.start_due_stream, stream['id'])
+
+    def add_stream(self, stream):
+        """Validate, persist and arm a new slot; returns its id"""
+        duration = parse_duration(stream['durasi'])
+        next_occurrence(stream['jam_mulai'])
+        if not os.path.exists(stream['video_path']):
+            raise ValueError(f"Video file not found: {stream['video_path']}")
+        if not stream.get('streaming_key'):
+            raise ValueError("Streaming key is required")
+        if stream.get('profile') and stream['profile'] not in profile_names():
+            raise ValueError(f"Unknown encoder profile: {stream['profile']}")
+        if stream.get('fill') and stream['fill'] not in FILL_POLICIES:
+            raise ValueError(f"Unknown fill policy: {stream['fill']}")
+
+        # Probe once at ingest so problems surface now rather than at air time
+        if self.streamer.probe:
+            errors, warnings = validate_slot(self.streamer.probe.probe(stream['video_path']), duration)
+            if errors:
+                raise ValueError("; ".join(errors))
+            for warning in warnings:
+                logger.warning(f"{stream['video_path']}: {warning}")
+
+        stream = dict(stream, status="Waiting")
+        stream['id'] = self.store.add(stream)
+        self.arm(stream)
+
+        # Pre-encode now so the slot airs with stream copy
+        if self.streamer.media_cache:
+            self.streamer.media_cache.prepare_async(stream['video_path'])
+        return stream['id']
+
+    def cancel_stream(self, stream_id):
+        """Cancel a waiting slot or stop a live one; False if there was nothing to cancel"""
+        self.timer.cancel(stream_id)
+        if self.store.transition(stream_id, "Waiting", "Cancelled"):
+            return True
+        if self.store.transition(stream_id, "Live", "Cancelled"):
+            self.stop_slot(stream_id)
+            return True
+        return False
+
+    def stream_airing(self, slot_id):
+        """Return (stream id, engine state) of the stream airing a slot, (None, None) if there is none"""
+        for stream_id, state in self.streamer.active_streams.items():
+            if slot_id in (state.options.get('tag') or [stream_id]):
+                return stream_id, state
+        return None, None
+
+    def stop_slot(self, slot_id):
+        """Take a live slot off air: stop the stream airing it, or end that stream's playlist right before it"""
+        stream_id, state = self.stream_airing(slot_id)
+        if stream_id is None:
+            return
+        slot_ids = state.options.get('tag') or [stream_id]
+        index = slot_ids.index(slot_id)
+        playlist = state.options.get('playlist')
+        if index == 0 or not playlist:
+            self.streamer.stop_stream(stream_id)
+            return
+        # Playlist items air back to back, the slot starts once the ones before it have played
+        self.streamer.cut_stream(stream_id, sum(duration for _, duration in playlist[:index]))
+
+    def stream_status(self, stream_id):
+        """Return a stored slot merged with the engine's live status, or None"""
+        stream = self.store.get(stream_id)
+        if stream:
+            stream['live'] = self.streamer.get_stream_status(stream_id, with_metrics=True)
+        return stream
+
+    def list_streams(self):
+        """Return every stored slot merged with the engine's live status"""
+        live = self.streamer.get_active_streams(with_metrics=True)
+        streams = self.store.all()
+        for stream in streams:
+            stream['live'] = live.get(stream['id'])
+        return streams
+
+    def referenced_paths(self):
+        """Return the video paths of every slot that has yet to air or is airing"""
+        return {stream['video_path'] for status in ("Waiting", "Live") for stream in self.store.by_status(status)}
+
+    def follow_on_slot(self, stream):
+        """Return the waiting slot starting exactly when stream ends on the same key(s)"""
+        if stream.get('fill') not in (None, 'none'):
+            # A filled slot needs its own cut-off, it is not chained into a playlist
+            return None
+        hour, minute = map(int, stream['jam_mulai'].split(':'))
+        end = (hour * 3600 + minute * 60 + parse_duration(stream['durasi'])) % 86400
+        if end % 60:
+            return None
+        end_str = f"{end // 3600:02d}:{end % 3600 // 60:02d}"
+        for other in self.store.starting_at(end_str, "Waiting"):
+            if (other['streaming_key'] == stream['streaming_key'] and other.get('fill') in (None, 'none')
+                    and self.chainable(stream, other)):
+                return other
+        return None
+
+    def chainable(self, stream, other):
+        """True if other can follow stream in one concat input and neither ends before its slot does
+
+        The concat demuxer decodes every item with the first one's codec
+        parameters, and an outpoint only cuts videos that run long, so a
+        short video would let the next slot air early. Slots that cannot be
+        verified by probing are aired separately.
+        """
+        probe = self.streamer.probe
+        if not probe or stream.get('profile') != other.get('profile'):
+            return False
+        first, second = probe.probe(stream['video_path']), probe.probe(other['video_path'])
+        for slot, info in ((stream, first), (other, second)):
+            if not info or (info.get('duration') or 0) < parse_duration(slot['durasi']):
+                return False
+        return same_layout(first, second)
+
+    def claim(self, stream_id):
+        """Take a due slot from Waiting to Live; False if someone else got it"""
+        return self.store.transition(stream_id, "Waiting", "Live")
+
+    def start_due_stream(self, stream_id):
+        """Timer callback that starts a scheduled stream"""
+        # Claiming the row makes sure only one scheduler starts the slot
+        stream = self.store.get(stream_id)
+        if not stream or not self.claim(stream_id):
+            return
+
+        # Back-to-back slots on the same key air as one gapless playlist
+        chain = [stream]
+        next_slot = self.follow_on_slot(stream)
+        while next_slot and self.claim(next_slot['id']):
+            self.timer.cancel(next_slot['id'])
+            chain.append(next_slot)
+            next_slot = self.follow_on_slot(next_slot)
+
+        # The journal keeps the slot ids, so a restarted engine can complete them too
+        slot_ids = [slot['id'] for slot in chain]
+        on_complete = self.completer(slot_ids)
+
+        # The slot's nominal start: the pre-roll gate and the base of schedule-to-live latency
+        horizon = datetime.now() + timedelta(seconds=self.preroll)
+        scheduled_at = next_occurrence(stream['jam_mulai'], horizon)
+        if scheduled_at > horizon:
+            scheduled_at -= timedelta(days=1)
+
+        # Several comma-separated keys are encoded once and fanned out
+        keys = [key.strip() for key in stream['streaming_key'].split(',') if key.strip()]
+
+        if len(chain) == 1:
+            started = self.streamer.start_stream(
+                stream['id'],
+                stream['video_path'],
+                keys,
+                parse_duration(stream['durasi']),
+                on_complete,
+                profile=stream.get('profile'),
+                scheduled_at=scheduled_at.timestamp(),
+                start_at=scheduled_at.timestamp() if self.preroll else None,
+                fill=stream.get('fill'),
+                tag=slot_ids
+            )
+        else:
+            started = self.streamer.start_playlist(
+                stream['id'],
+                [(slot['video_path'], parse_duration(slot['durasi'])) for slot in chain],
+                keys,
+                on_complete,
+                profile=stream.get('profile'),
+                scheduled_at=scheduled_at.timestamp(),
+                start_at=scheduled_at.timestamp() if self.preroll else None,
+                tag=slot_ids
+            )
+        if not started:
+            logger.error(f"Stream {stream_id} could not be started")
+            for slot in chain:
+                self.store.update_status(slot['id'], "Error")
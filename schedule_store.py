@@ -0,0 +1,226 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger('schedule_store')
+
+COLUMNS = ("id", "video", "video_path", "durasi", "jam_mulai", "streaming_key", "status", "profile", "fill",
+           "owner", "lease_expires")
+
+# Optional columns added after the first release, with their types
+OPTIONAL_COLUMNS = {"profile": "TEXT", "fill": "TEXT", "owner": "TEXT", "lease_expires": "REAL"}
+
+# Statuses the Tk scheduler used to write, mapped to the one vocabulary the store keeps
+LEGACY_STATUSES = {"Menunggu": "Waiting", "Sedang Live": "Live", "Selesai": "Completed"}
+
+
+class ScheduleStore:
+    """Persistent schedule of streams backed by SQLite in WAL mode.
+
+    Every change is a single-row statement, so saving costs O(1) per change
+    instead of rewriting the whole schedule. WAL lets the GUI, the Streamlit
+    app and background threads read while another writer commits.
+    """
+
+    def __init__(self, path='streams.db', legacy_json=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS streams (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    video TEXT,
+                    video_path TEXT NOT NULL,
+                    durasi TEXT NOT NULL,
+                    jam_mulai TEXT NOT NULL,
+                    streaming_key TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    profile TEXT,
+                    fill TEXT,
+                    owner TEXT,
+                    lease_expires REAL,
+                    updated_at REAL NOT NULL
+                )
+            """)
+            # Sharded workers announce their health and load here
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS workers (
+                    id TEXT PRIMARY KEY,
+                    host TEXT,
+                    pid INTEGER,
+                    capacity INTEGER,
+                    load INTEGER,
+                    heartbeat REAL NOT NULL
+                )
+            """)
+            # Stores created by older versions lack the newer optional columns
+            columns = [row[1] for row in self.conn.execute("PRAGMA table_info(streams)")]
+            for column, kind in OPTIONAL_COLUMNS.items():
+                if column not in columns:
+                    self.conn.execute(f"ALTER TABLE streams ADD COLUMN {column} {kind}")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_streams_jam_mulai ON streams (jam_mulai)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_streams_status ON streams (status)")
+            for legacy, status in LEGACY_STATUSES.items():
+                self.conn.execute("UPDATE streams SET status = ? WHERE status = ?", (status, legacy))
+
+        if legacy_json:
+            self.import_json(legacy_json)
+
+    def import_json(self, json_path):
+        """One-off migration of a legacy streams.json into an empty store"""
+        if not os.path.exists(json_path) or self.count():
+            return
+        try:
+            with open(json_path, "r") as f:
+                streams = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Cannot import {json_path}: {str(e)}")
+            return
+
+        for stream in streams:
+            self.add(stream)
+        logger.info(f"Imported {len(streams)} streams from {json_path}")
+
+    def _row(self, row):
+        """Convert a sqlite3.Row into the dict shape the UIs use"""
+        return {column: row[column] for column in COLUMNS} if row else None
+
+    def count(self):
+        """Return the number of scheduled streams"""
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM streams").fetchone()[0]
+
+    def add(self, stream):
+        """Insert a stream and return its id"""
+        with self.lock:
+            cursor = self.conn.execute(
+                "INSERT INTO streams (id, video, video_path, durasi, jam_mulai, streaming_key, status, profile, fill,"
+                " updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    stream.get("id"),
+                    stream.get("video") or os.path.basename(stream["video_path"]),
+                    stream["video_path"],
+                    stream["durasi"],
+                    stream["jam_mulai"],
+                    stream["streaming_key"],
+                    LEGACY_STATUSES.get(stream["status"], stream["status"]),
+                    stream.get("profile"),
+                    stream.get("fill"),
+                    time.time()
+                )
+            )
+            return cursor.lastrowid
+
+    def get(self, stream_id):
+        """Return one stream as a dict, or None"""
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM streams WHERE id = ?", (stream_id,)).fetchone()
+        return self._row(row)
+
+    def all(self):
+        """Return every stream ordered by id"""
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM streams ORDER BY id").fetchall()
+        return [self._row(row) for row in rows]
+
+    def by_status(self, status):
+        """Return streams in one status, ordered by start time"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM streams WHERE status = ? ORDER BY jam_mulai, id", (status,)
+            ).fetchall()
+        return [self._row(row) for row in rows]
+
+    def starting_at(self, jam_mulai, status):
+        """Return streams in a status scheduled for an "HH:MM" slot"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM streams WHERE jam_mulai = ? AND status = ? ORDER BY id", (jam_mulai, status)
+            ).fetchall()
+        return [self._row(row) for row in rows]
+
+    def update_status(self, stream_id, status):
+        """Set the status of one stream"""
+        with self.lock:
+            self.conn.execute(
+                "UPDATE streams SET status = ?, updated_at = ? WHERE id = ?",
+                (LEGACY_STATUSES.get(status, status), time.time(), stream_id)
+            )
+
+    def transition(self, stream_id, from_status, to_status):
+        """Atomically move a stream between statuses; False if it was not in from_status
+
+        This is the claim primitive: when several schedulers race to start
+        the same slot, exactly one of them wins.
+        """
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE streams SET status = ?, updated_at = ? WHERE id = ? AND status = ?",
+                (to_status, time.time(), stream_id, from_status)
+            )
+            return cursor.rowcount == 1
+
+    def claim(self, stream_id, owner, lease_expires, from_status, to_status=None):
+        """Lease a stream to owner, optionally moving it to to_status; False if another owner's lease still holds
+
+        A stream is free to claim when it has no owner, is already ours, or
+        its lease has run out because the owner stopped renewing it.
+        """
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE streams SET status = ?, owner = ?, lease_expires = ?, updated_at = ?"
+                " WHERE id = ? AND status = ?"
+                " AND (owner IS NULL OR owner = ? OR lease_expires IS NULL OR lease_expires < ?)",
+                (to_status or from_status, owner, lease_expires, now, stream_id, from_status, owner, now)
+            )
+            return cursor.rowcount == 1
+
+    def renew_leases(self, owner, lease_expires, stream_ids):
+        """Extend owner's leases on the given waiting or live streams"""
+        with self.lock:
+            self.conn.executemany(
+                "UPDATE streams SET lease_expires = ? WHERE id = ? AND owner = ? AND status IN ('Waiting', 'Live')",
+                [(lease_expires, stream_id, owner) for stream_id in stream_ids]
+            )
+
+    def expired(self, status):
+        """Return streams in a status whose lease ran out, with updated_at (when they entered it)"""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM streams WHERE status = ? AND (lease_expires IS NULL OR lease_expires < ?)"
+                " ORDER BY jam_mulai, id",
+                (status, time.time())
+            ).fetchall()
+        return [dict(self._row(row), updated_at=row["updated_at"]) for row in rows]
+
+    def heartbeat(self, worker_id, host, pid, capacity, load):
+        """Record that a worker is alive and how busy it is"""
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO workers (id, host, pid, capacity, load, heartbeat) VALUES (?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT(id) DO UPDATE SET host = excluded.host, pid = excluded.pid,"
+                " capacity = excluded.capacity, load = excluded.load, heartbeat = excluded.heartbeat",
+                (worker_id, host, pid, capacity, load, time.time())
+            )
+
+    def workers(self, max_age=None):
+        """Return the workers, only those heard from within max_age seconds when given"""
+        since = time.time() - max_age if max_age is not None else 0
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT * FROM workers WHERE heartbeat >= ? ORDER BY id", (since,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def delete(self, stream_id):
+        """Remove a stream from the schedule"""
+        with self.lock:
+            self.conn.execute("DELETE FROM streams WHERE id = ?", (stream_id,))
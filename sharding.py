@@ -0,0 +1,248 @@
+import logging
+import math
+import os
+import socket
+import time
+from datetime import datetime, timedelta
+
+from resource_limits import available_cores
+from schedule_runner import ScheduleRunner, parse_duration
+from timer_queue import next_occurrence
+
+logger = logging.getLogger('sharding')
+
+# A worker that has not renewed its leases for this long is presumed dead
+LEASE_SECONDS = 30
+# How often a worker heartbeats, renews its leases and looks for work
+TICK_SECONDS = 5
+# Slots starting within this many seconds (plus pre-roll) are claimed ahead of time
+CLAIM_HORIZON = 120
+
+
+def slot_window(stream, at):
+    """Return (start, end) of the occurrence of a daily slot airing at `at`, or else the next one"""
+    duration = timedelta(seconds=parse_duration(stream['durasi']))
+    start = next_occurrence(stream['jam_mulai'], at)
+    if start > at:
+        start -= timedelta(days=1)
+    if start + duration <= at:
+        start += timedelta(days=1)
+    return start, start + duration
+
+
+class ScheduleCoordinator(ScheduleRunner):
+    """Front end of a sharded schedule: validates and stores slots but airs nothing itself.
+
+    Slots are written to the shared store unowned and ScheduleWorker
+    processes claim and air them. Cancelling a live slot only changes its
+    status; the worker holding it notices on its next tick and stops it.
+    """
+
+    def start(self):
+        """Nothing to arm, workers own every start timer"""
+        logger.info("Coordinating the schedule, slots are aired by workers")
+
+    def arm(self, stream):
+        """Workers arm the slots they claim"""
+
+    def cancel_stream(self, stream_id):
+        """Cancel a waiting or live slot; False if there was nothing to cancel"""
+        return (self.store.transition(stream_id, "Waiting", "Cancelled")
+                or self.store.transition(stream_id, "Live", "Cancelled"))
+
+
+class ScheduleWorker(ScheduleRunner):
+    """One shard of a schedule shared through the store by several worker processes on one host.
+
+    Every tick a worker renews the leases of the slots it holds, stops
+    streams whose slot was cancelled or handed over, takes over live slots
+    whose lease ran out (resuming them where they should be by now), claims
+    upcoming unowned slots up to a fair share of the total load, and
+    heartbeats its load to the store. Claims are conditional updates, so a
+    slot is only ever leased to one worker.
+
+    The store is SQLite in WAL mode, whose shared-memory index only works
+    between processes on one host: every worker must run on the host that
+    has the database on a local filesystem, never over a network mount.
+    """
+
+    def __init__(self, store, streamer, worker_id=None, capacity=None, lease=LEASE_SECONDS, tick=TICK_SECONDS,
+                 horizon=CLAIM_HORIZON, **kwargs):
+        super().__init__(store, streamer, **kwargs)
+        # A stable id lets a restarted worker keep its leases and journaled streams
+        self.worker_id = worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        if capacity is None:
+            capacity = streamer.admission.max_encodes if streamer.admission else len(available_cores())
+        self.capacity = capacity
+        self.lease = lease
+        self.tick_seconds = tick
+        self.horizon = horizon
+        # Claimed waiting slots with a start timer on this worker
+        self.armed = set()
+        # Slots about to start that were left to peers last tick
+        self.deferred = set()
+
+    def start(self):
+        """Start the timer thread, re-adopt journaled streams and begin ticking"""
+        self.timer.start()
+        # Streams whose slot moved on are stopped by the first tick
+        self.streamer.recover(lambda tag: self.completer(tag or []))
+        self.tick()
+
+    def arm(self, stream):
+        """Arm the start timer of a slot this worker holds"""
+        if stream.get('owner') == self.worker_id:
+            self.armed.add(stream['id'])
+            super().arm(stream)
+
+    def claim(self, stream_id):
+        """Take a due slot from Waiting to Live under this worker's lease"""
+        self.armed.discard(stream_id)
+        return self.store.claim(stream_id, self.worker_id, time.time() + self.lease, "Waiting", "Live")
+
+    def settle_slot(self, slot_id, status):
+        """Move a slot off Live once its stream has ended, leaving slots handed to another worker alone"""
+        if self.store.claim(slot_id, self.worker_id, None, "Live", status) and status == "Waiting":
+            self.arm(self.store.get(slot_id))
+
+    def cancel_stream(self, stream_id):
+        """Cancel a slot; a live one held by another worker is stopped by that worker's tick"""
+        self.timer.cancel(stream_id)
+        self.armed.discard(stream_id)
+        if self.store.transition(stream_id, "Waiting", "Cancelled"):
+            return True
+        if self.store.transition(stream_id, "Live", "Cancelled"):
+            self.stop_slot(stream_id)
+            return True
+        return False
+
+    def airing(self):
+        """Slot ids this worker's engine is airing, chained slots included"""
+        slot_ids = set()
+        for stream_id, state in self.streamer.active_streams.items():
+            slot_ids.add(stream_id)
+            slot_ids.update(state.options.get('tag') or [])
+        return slot_ids
+
+    def tick(self):
+        """Timer callback doing one round of lease keeping and claiming, then re-arming itself"""
+        try:
+            waiting = self.store.by_status("Waiting")
+            held = [stream for stream in waiting if stream['owner'] == self.worker_id]
+            airing = self.airing()
+            self.store.renew_leases(self.worker_id, time.time() + self.lease,
+                                    airing | {stream['id'] for stream in held})
+            self.reconcile()
+
+            # Slots this worker held before a restart need their timers again
+            for stream in held:
+                if stream['id'] not in self.armed:
+                    self.arm(stream)
+
+            self.take_over(airing)
+            load = len(self.streamer.active_streams) + len(held)
+            load += self.claim_upcoming(waiting, load)
+            self.store.heartbeat(self.worker_id, socket.gethostname(), os.getpid(), self.capacity, load)
+        except Exception as e:
+            logger.error(f"Worker {self.worker_id} tick failed: {str(e)}")
+        finally:
+            self.timer.schedule(('tick', self.worker_id), time.time() + self.tick_seconds, self.tick)
+
+    def reconcile(self):
+        """Take slots that were cancelled or leased to another worker meanwhile off air"""
+        for stream_id, state in self.streamer.active_streams.items():
+            # A playlist is cut before its first slot that is lost
+            for slot_id in state.options.get('tag') or [stream_id]:
+                stream = self.store.get(slot_id)
+                if not stream or stream['status'] != "Live" or stream['owner'] != self.worker_id:
+                    logger.warning(f"Stream {slot_id} is no longer held by {self.worker_id}, taking it off air")
+                    self.stop_slot(slot_id)
+                    break
+
+    def take_over(self, airing):
+        """Claim live slots whose owner stopped renewing them and air them from where they should be"""
+        for stream in self.store.expired("Live"):
+            if stream['id'] in airing:
+                continue
+            if len(self.streamer.active_streams) >= self.capacity:
+                break
+            if not self.store.claim(stream['id'], self.worker_id, time.time() + self.lease, "Live"):
+                # Another worker was faster
+                continue
+            logger.warning(f"Worker {self.worker_id} taking over stream {stream['id']} from {stream['owner']}")
+            self.resume_slot(stream)
+
+    def resume_slot(self, stream):
+        """Continue a live slot claimed from a dead worker"""
+        now = datetime.now()
+        # The occurrence that was on air is the one current when the slot went Live
+        start, end = slot_window(stream, datetime.fromtimestamp(stream['updated_at']))
+        # The previous owner was last alive one lease before its lease expired
+        last_seen = datetime.fromtimestamp((stream['lease_expires'] or stream['updated_at']) - self.lease)
+
+        if start > now:
+            # A chained follow-on that had not started yet, it airs on its own
+            if self.store.claim(stream['id'], self.worker_id, time.time() + self.lease, "Live", "Waiting"):
+                self.arm(dict(stream, owner=self.worker_id))
+            return
+        if end <= now:
+            status = "Completed" if end <= last_seen else "Error"
+            self.store.claim(stream['id'], self.worker_id, None, "Live", status)
+            return
+
+        keys = [key.strip() for key in stream['streaming_key'].split(',') if key.strip()]
+        # A dead worker's ffmpeg may outlive it; only one publisher per key
+        self.streamer.stop_orphans(keys)
+        started = self.streamer.start_stream(
+            stream['id'],
+            stream['video_path'],
+            keys,
+            (end - now).total_seconds(),
+            self.completer([stream['id']]),
+            profile=stream.get('profile'),
+            scheduled_at=start.timestamp(),
+            fill=stream.get('fill'),
+            tag=[stream['id']],
+            offset=(now - start).total_seconds()
+        )
+        if not started:
+            logger.error(f"Stream {stream['id']} could not be taken over")
+            self.store.update_status(stream['id'], "Error")
+
+    def claim_upcoming(self, waiting, load):
+        """Lease upcoming unowned slots up to this worker's fair share; returns how many were claimed"""
+        now = datetime.now()
+        cutoff = now + timedelta(seconds=self.horizon + self.preroll)
+        free = []
+        for stream in waiting:
+            if stream['owner'] == self.worker_id or (stream['lease_expires'] or 0) >= time.time():
+                continue
+            due = next_occurrence(stream['jam_mulai'], now)
+            if due <= cutoff:
+                free.append((due, stream))
+        if not free:
+            self.deferred = set()
+            return 0
+
+        # Spread what is running and what is about to start evenly over the live workers
+        peers = [worker for worker in self.store.workers(max_age=self.lease) if worker['id'] != self.worker_id]
+        share = math.ceil((load + sum(worker['load'] for worker in peers) + len(free)) / (len(peers) + 1))
+        # Past the fair share, slots about to start are left to peers for one tick
+        # and only claimed if still nobody took them
+        urgent = now + timedelta(seconds=self.preroll + 2 * self.tick_seconds)
+        deferred, self.deferred = self.deferred, set()
+
+        claimed = 0
+        for due, stream in sorted(free, key=lambda item: (item[0], item[1]['id'])):
+            if load + claimed >= self.capacity:
+                logger.warning(f"Worker {self.worker_id} is at capacity ({self.capacity} streams)")
+                break
+            if load + claimed >= share and (due > urgent or stream['id'] not in deferred):
+                if due <= urgent:
+                    self.deferred.add(stream['id'])
+                continue
+            expires = time.time() + self.lease
+            if self.store.claim(stream['id'], self.worker_id, expires, "Waiting"):
+                self.arm(dict(stream, owner=self.worker_id, lease_expires=expires))
+                claimed += 1
+        return claimed
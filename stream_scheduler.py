@@ -2,9 +2,22 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 import os
 import datetime
-import threading
 import time
-import json
+import queue
+from timer_queue import TimerQueue, next_occurrence
+from schedule_store import ScheduleStore
+from media_probe import MediaProbe, validate_slot
+
+# Rows materialised in the Treeview at once; larger schedules are paged
+PAGE_SIZE = 200
+# How often the Tk thread applies row updates queued by worker threads
+UI_POLL_MS = 200
+# This app only simulates streaming, its schedule is kept apart from the one the daemon airs
+SCHEDULE_DB = 'scheduler.db'
+# Schedule this app saved before it moved to SQLite; only ever imported into SCHEDULE_DB
+LEGACY_JSON = 'streams.json'
+# Table labels of the store's statuses
+STATUS_LABELS = {"Waiting": "Menunggu", "Live": "Sedang Live", "Completed": "Selesai"}
 
 class StreamingScheduler:
     def __init__(self, root):
@@ -15,7 +28,15 @@ class StreamingScheduler:
         
         # Data structure to store streaming tasks
         self.streams = []
-        self.stream_threads = {}
+        self.timer = TimerQueue()
+        self.store = ScheduleStore(SCHEDULE_DB, legacy_json=LEGACY_JSON)
+        self.probe = MediaProbe()
+        
+        # Table view state: stream id -> [Treeview item, displayed values]
+        self.rows = {}
+        self.page = 0
+        # Stream ids whose row changed off the Tk thread
+        self.ui_queue = queue.Queue()
         
         # Load saved streams if available
         self.load_streams()
@@ -66,6 +87,14 @@ class StreamingScheduler:
         self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         scrollbar.config(command=self.tree.yview)
         
+        # Paging controls
+        page_frame = ttk.Frame(main_frame)
+        page_frame.pack(fill=tk.X)
+        ttk.Button(page_frame, text="< Sebelumnya", command=lambda: self.change_page(-1)).pack(side=tk.LEFT)
+        self.page_label = ttk.Label(page_frame, text="")
+        self.page_label.pack(side=tk.LEFT, padx=10)
+        ttk.Button(page_frame, text="Berikutnya >", command=lambda: self.change_page(1)).pack(side=tk.LEFT)
+        
         # Input frame
         input_frame = ttk.Frame(main_frame)
         input_frame.pack(fill=tk.X, pady=(10, 0))
@@ -116,10 +145,13 @@ class StreamingScheduler:
         
         # Load existing streams into the table
         self.refresh_table()
+        self.root.after(UI_POLL_MS, self.drain_ui_queue)
         
-        # Start checking for streams to start
-        self.check_stream_thread = threading.Thread(target=self.check_streams, daemon=True)
-        self.check_stream_thread.start()
+        # Arm a start timer for every waiting stream, and the end of any left live
+        for stream in self.streams:
+            self.schedule_stream(stream)
+            self.resume_stream(stream)
+        self.timer.start()
         
     def browse_video(self):
         file_path = filedialog.askopenfilename(
@@ -148,70 +180,147 @@ class StreamingScheduler:
             messagebox.showerror("Error", "Please enter a streaming key")
             return
         
+        try:
+            h, m, s = map(int, durasi.split(':'))
+        except ValueError:
+            messagebox.showerror("Error", "Duration must be hh:mm:ss")
+            return
+        
+        # Check the file now instead of at air time
+        errors, warnings = validate_slot(self.probe.probe(video_path), h * 3600 + m * 60 + s)
+        if errors:
+            messagebox.showerror("Error", "\n".join(errors))
+            return
+        if warnings:
+            messagebox.showwarning("Warning", "\n".join(warnings))
+        
         # Add to the streams list
-        stream_id = len(self.streams) + 1
         stream = {
-            "id": stream_id,
             "video": os.path.basename(video_path),
             "video_path": video_path,
             "durasi": durasi,
             "jam_mulai": jam_mulai,
             "streaming_key": streaming_key,
-            "status": "Menunggu"  # Waiting
+            "status": "Waiting"
         }
         
+        stream["id"] = self.store.add(stream)
         self.streams.append(stream)
-        self.save_streams()
+        self.schedule_stream(stream)
         self.refresh_table()
         
         # Reset input fields
         self.video_path_var.set("")
         self.streaming_key_var.set("")
     
+    def row_values(self, index, stream):
+        """Return the Treeview values for one stream"""
+        return (
+            index,
+            stream["video"],
+            stream["durasi"],
+            stream["jam_mulai"],
+            stream["streaming_key"],
+            STATUS_LABELS.get(stream["status"], stream["status"]),
+            "-"
+        )
+    
+    def change_page(self, step):
+        """Move the table to the previous/next page"""
+        self.page += step
+        self.refresh_table()
+    
     def refresh_table(self):
-        # Clear the table
-        for item in self.tree.get_children():
-            self.tree.delete(item)
-        
-        # Populate with current streams
-        for i, stream in enumerate(self.streams, 1):
-            self.tree.insert("", "end", values=(
-                i,
-                stream["video"],
-                stream["durasi"],
-                stream["jam_mulai"],
-                stream["streaming_key"],
-                stream["status"],
-                "-"
-            ))
+        """Sync the visible page with self.streams, touching only rows and cells that changed"""
+        pages = max(1, (len(self.streams) + PAGE_SIZE - 1) // PAGE_SIZE)
+        self.page = min(max(self.page, 0), pages - 1)
+        self.page_label.config(text=f"Halaman {self.page + 1}/{pages}")
+        
+        first = self.page * PAGE_SIZE
+        wanted = {
+            stream["id"]: self.row_values(first + offset + 1, stream)
+            for offset, stream in enumerate(self.streams[first:first + PAGE_SIZE])
+        }
+        
+        # Drop rows that left the page
+        for stream_id in [stream_id for stream_id in self.rows if stream_id not in wanted]:
+            self.tree.delete(self.rows.pop(stream_id)[0])
+        
+        for position, (stream_id, values) in enumerate(wanted.items()):
+            row = self.rows.get(stream_id)
+            if row is None:
+                item = self.tree.insert("", position, values=values)
+                self.rows[stream_id] = [item, values]
+            else:
+                self.update_cells(row, values)
+    
+    def update_cells(self, row, values):
+        """Write only the cells of a row whose value changed"""
+        item, shown = row
+        columns = self.tree["columns"]
+        for column, old, new in zip(columns, shown, values):
+            if old != new:
+                self.tree.set(item, column, new)
+        row[1] = values
+    
+    def update_row(self, stream_id):
+        """Refresh one stream's row if it is on the visible page"""
+        row = self.rows.get(stream_id)
+        if row is None:
+            return
+        stream = next((s for s in self.streams if s["id"] == stream_id), None)
+        if stream:
+            self.update_cells(row, self.row_values(row[1][0], stream))
     
-    def check_streams(self):
-        """Check if any streams need to be started based on the schedule"""
-        while True:
-            current_time = datetime.datetime.now()
-            current_time_str = f"{current_time.hour:02d}:{current_time.minute:02d}"
-            
-            for stream in self.streams:
-                stream_id = stream["id"]
-                if stream["jam_mulai"] == current_time_str and stream["status"] == "Menunggu":
-                    # Start the stream
-                    stream["status"] = "Sedang Live"
-                    self.save_streams()
-                    
-                    # Start the streaming in a separate thread
-                    stream_thread = threading.Thread(
-                        target=self.start_stream,
-                        args=(stream,),
-                        daemon=True
-                    )
-                    self.stream_threads[stream_id] = stream_thread
-                    stream_thread.start()
-                    
-                    # Update the table
-                    self.refresh_table()
-            
-            # Check every 10 seconds
-            time.sleep(10)
+    def notify(self, stream_id):
+        """Queue a row refresh; safe to call from any thread"""
+        self.ui_queue.put(stream_id)
+    
+    def drain_ui_queue(self):
+        """Apply queued row refreshes in one batch on the Tk thread"""
+        changed = set()
+        try:
+            while True:
+                changed.add(self.ui_queue.get_nowait())
+        except queue.Empty:
+            pass
+        
+        for stream_id in changed:
+            self.update_row(stream_id)
+        self.root.after(UI_POLL_MS, self.drain_ui_queue)
+    
+    def schedule_stream(self, stream):
+        """Arm the start timer for a waiting stream at its next jam_mulai"""
+        if stream["status"] != "Waiting":
+            return
+        start_at = next_occurrence(stream["jam_mulai"])
+        self.timer.schedule(stream["id"], start_at, self.on_stream_due, stream)
+    
+    def resume_stream(self, stream):
+        """Re-arm the end timer of a stream that was live when the app last closed"""
+        if stream["status"] != "Live":
+            return
+        h, m, s = map(int, stream["durasi"].split(':'))
+        now = datetime.datetime.now()
+        # The interrupted run began at the latest jam_mulai not after now
+        started = next_occurrence(stream["jam_mulai"], now)
+        if started > now:
+            started -= datetime.timedelta(days=1)
+        # A slot that ended while the app was closed completes right away
+        end = started + datetime.timedelta(hours=h, minutes=m, seconds=s)
+        self.timer.schedule(("end", stream["id"]), end, self.finish_stream, stream)
+    
+    def on_stream_due(self, stream):
+        """Timer callback that starts a stream at its scheduled time"""
+        if stream["status"] != "Waiting":
+            return
+        
+        stream["status"] = "Live"
+        self.store.update_status(stream["id"], stream["status"])
+        self.start_stream(stream)
+        
+        # Update the table from the Tk thread
+        self.notify(stream["id"])
     
     def start_stream(self, stream):
         """Start the RTMP stream to YouTube"""
@@ -230,31 +339,24 @@ class StreamingScheduler:
         h, m, s = map(int, stream["durasi"].split(':'))
         duration_seconds = h * 3600 + m * 60 + s
         
-        # Simulate streaming for the specified duration
-        time.sleep(duration_seconds)
-        
+        # Simulate streaming for the specified duration; the end is a timer on
+        # the shared queue rather than a thread sleeping per stream
+        self.timer.schedule(("end", stream["id"]), time.time() + duration_seconds, self.finish_stream, stream)
+    
+    def finish_stream(self, stream):
+        """Timer callback that marks a stream as completed once its duration has elapsed"""
         # Update status when done
         for s in self.streams:
             if s["id"] == stream["id"]:
-                s["status"] = "Selesai"  # Completed
+                s["status"] = "Completed"
         
-        self.save_streams()
-        self.refresh_table()
-    
-    def save_streams(self):
-        """Save streams to a file"""
-        try:
-            with open("streams.json", "w") as f:
-                json.dump(self.streams, f)
-        except Exception as e:
-            print(f"Error saving streams: {e}")
+        self.store.update_status(stream["id"], "Completed")
+        self.notify(stream["id"])
     
     def load_streams(self):
-        """Load streams from a file"""
+        """Load streams from the schedule store"""
         try:
-            if os.path.exists("streams.json"):
-                with open("streams.json", "r") as f:
-                    self.streams = json.load(f)
+            self.streams = self.store.all()
         except Exception as e:
             print(f"Error loading streams: {e}")
             self.streams = []
@@ -1,3 +1,5 @@
+import asyncio
+import concurrent.futures
 import subprocess
 import logging
 import os
@@ -5,6 +7,10 @@ import threading
 import time
 from datetime import datetime
 import signal
+from ffmpeg_progress import ProgressTracker
+from encoder_profiles import plan_encode, profile_names
+from ffmpeg_caps import ffmpeg_capabilities
+from metrics import MetricsRegistry, process_cpu_seconds
 
 # Set up logging
 logging.basicConfig(
@@ -14,172 +20,1497 @@ logging.basicConfig(
 )
 logger = logging.getLogger('streaming_engine')
 
+# Where ffconcat playlists for gapless multi-video streams are written
+PLAYLIST_DIR = 'playlists'
+
+# x264 presets from fastest to slowest; a load override may only move a stream towards the front
+X264_PRESETS = ['ultrafast', 'superfast', 'veryfast', 'faster', 'fast', 'medium', 'slow', 'slower', 'veryslow']
+
+# Audio every input spliced into one encode is conformed to
+SPLICE_AUDIO = 'aresample=44100,aformat=sample_fmts=fltp:channel_layouts=stereo'
+
+# What fills a slot once its video ends early: nothing, the video looped, or a filler clip
+FILL_POLICIES = ['none', 'loop', 'filler']
+
+# Bare stream keys are appended to this; point it at a local server for testing
+DEFAULT_INGEST_URL = 'rtmp://a.rtmp.youtube.com/live2'
+
+# Seconds between run journal heartbeats, the precision of the crash time on recovery
+JOURNAL_HEARTBEAT = 2
+
+# Seconds between samples of the CPU cost of running encodes, for admission control
+COST_SAMPLE_INTERVAL = 5
+
+# Seconds ffmpeg gets to finish cleanly after 'q' on stdin, and then after SIGTERM, before it is killed
+QUIT_GRACE = 5
+
+def mask_rtmp_url(url):
+    """Hide all but the last 4 characters of the stream key in an RTMP URL"""
+    base, _, key = url.rpartition('/')
+    return f"{base}/{'*' * max(len(key) - 4, 0)}{key[-4:]}"
+
+class ReconnectPolicy:
+    """Exponential backoff settings for resuming a stream after ffmpeg fails"""
+    
+    def __init__(self, max_attempts=5, base_delay=1.0, max_delay=30.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+    
+    def delay(self, attempt):
+        """Return the wait before reconnect number attempt (0-based)"""
+        return min(self.base_delay * 2 ** attempt, self.max_delay)
+
+class AdoptedProcess:
+    """Popen-like handle on an ffmpeg re-adopted from a previous engine run
+    
+    The process is not our child, so it cannot be waited on and its exit
+    code is never known; liveness is polled with signal 0 instead.
+    """
+    
+    def __init__(self, pid, started=None):
+        self.pid = pid
+        # Epoch the adopted attempt was spawned, its output clock starts there
+        self.started = started or time.time()
+        self.returncode = None
+    
+    def poll(self):
+        """Return None while the process runs, -1 once it is gone"""
+        if self.returncode is None:
+            try:
+                os.kill(self.pid, 0)
+            except ProcessLookupError:
+                self.returncode = -1
+            except PermissionError:
+                pass
+        return self.returncode
+    
+    def wait(self, timeout=None):
+        """Poll until the process is gone, raising TimeoutExpired after timeout seconds"""
+        end = time.time() + timeout if timeout is not None else None
+        while self.poll() is None:
+            if end is not None and time.time() >= end:
+                raise subprocess.TimeoutExpired(f"pid {self.pid}", timeout)
+            time.sleep(0.1)
+        return self.returncode
+
+# Legal status changes of a stream; completed, error and stopped are final
+TRANSITIONS = {
+    'queued': {'initializing', 'completed', 'error', 'stopped'},
+    'initializing': {'connecting', 'error', 'stopped'},
+    'connecting': {'streaming', 'error', 'stopped'},
+    'streaming': {'completed', 'reconnecting', 'error', 'stopped'},
+    'reconnecting': {'connecting', 'error', 'stopped'},
+    'completed': set(),
+    'error': set(),
+    'stopped': set()
+}
+
+class StreamState:
+    """Runtime state of one registered stream
+    
+    Status changes go through transition() so concurrent supervisors,
+    admission callbacks and stop_stream() calls cannot move a stream
+    backwards or out of a final state. Every other field has a single
+    writer, its supervisor.
+    """
+    
+    __slots__ = ('stream_id', 'status', 'thread', 'task', 'start_time', 'process', 'progress',
+                 'outputs', 'options', 'reconnects', 'downtime', 'scheduled_at', 'live', 'played', 'lead',
+                 'deadline', 'attempt_start', 'outage_start', 'done', 'stopping', 'on_complete')
+    
+    # Transitions are rare, one lock for all streams is plenty
+    _lock = threading.Lock()
+    
+    def __init__(self, stream_id, status, outputs, options):
+        self.stream_id = stream_id
+        self.status = status
+        self.thread = None
+        self.task = None
+        self.start_time = datetime.now()
+        self.process = None
+        self.progress = ProgressTracker()
+        self.outputs = outputs
+        self.options = options
+        self.reconnects = 0
+        self.downtime = 0.0
+        # Epoch the stream was due, for schedule-to-live latency
+        self.scheduled_at = options.get('scheduled_at') or time.time()
+        self.live = False
+        # Content seconds aired by earlier attempts, and the slate lead of the current one
+        self.played = 0.0
+        self.lead = 0.0
+        # Epoch the slot ends, the spawn time of the current attempt and the start of a reconnect outage
+        self.deadline = None
+        self.attempt_start = None
+        self.outage_start = None
+        # Resolved with the final status once the stream has left the engine and its ffmpeg has exited
+        self.done = concurrent.futures.Future()
+        # Resolved by stop_stream(), wakes a supervisor that is waiting
+        self.stopping = concurrent.futures.Future()
+        # Completion callback, for a stream stopped while it waits for admission
+        self.on_complete = None
+    
+    def transition(self, status, expected=None):
+        """Atomically move to status; False if that is not a legal move (or the status is not expected)"""
+        with self._lock:
+            if expected is not None and self.status != expected:
+                return False
+            if status not in TRANSITIONS[self.status]:
+                logger.debug(f"Stream {self.stream_id} ignoring transition {self.status} -> {status}")
+                return False
+            self.status = status
+            return True
+
 class RTMPStreamer:
-    def __init__(self):
+    def __init__(self, media_cache=None, mode='thread', admission=None, reconnect=None, probe=None,
+                 metrics=None, events=None, ingest_url=DEFAULT_INGEST_URL, resources=None, filler_path=None,
+                 journal=None, capabilities=None):
+        # Copy-on-write registry: writers swap in a new dict under the lock,
+        # readers take the current one without locking
         self.active_streams = {}
+        self.registry_lock = threading.Lock()
+        self.media_cache = media_cache
+        self.probe = probe
+        self.admission = admission
+        self.reconnect = reconnect
+        self.resources = resources
+        self.ingest_url = ingest_url.rstrip('/')
+        # Clip chained after short videos by the 'filler' policy; black and silent when unset
+        self.filler_path = filler_path
+        # Discovered once per binary and cached on disk, so building an engine does not fork
+        self.capabilities = capabilities or ffmpeg_capabilities()
         self.ffmpeg_available = self.check_ffmpeg()
         
+        # Telemetry; a private registry keeps the engine usable without an exporter
+        self.metrics = metrics or MetricsRegistry()
+        self.events = events
+        self._init_metrics()
+        
+        # Run journal for crash recovery; with one, ffmpeg runs in its own session
+        # so it outlives the engine and can be re-adopted by the next run
+        self.journal = journal
+        if journal:
+            threading.Thread(target=self._heartbeat, daemon=True).start()
+        
+        # Without a fixed limit the encode capacity follows the measured cost of running encodes
+        if admission and admission.fixed_limit is None:
+            threading.Thread(target=self._sample_cost, daemon=True).start()
+        
+        # In 'async' mode every ffmpeg child is supervised from one event loop
+        # instead of a dedicated polling thread per stream
+        self.mode = mode
+        self.loop = None
+        self.loop_thread = None
+        if mode == 'async':
+            self.loop = asyncio.new_event_loop()
+            self.loop_thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+            self.loop_thread.start()
+        elif mode != 'thread':
+            raise ValueError(f"Unknown supervisor mode: {mode}")
+        
+    def _init_metrics(self):
+        """Create the engine's metric families and its scrape-time collector"""
+        m = self.metrics
+        self.m_started = m.counter('rtmp_streams_started_total', "Streams registered with the engine")
+        self.m_finished = m.counter('rtmp_streams_finished_total', "Streams that left the engine, by final status",
+                                    ('status',))
+        self.m_spawns = m.counter('rtmp_ffmpeg_spawns_total', "ffmpeg processes started, reconnects included")
+        self.m_exits = m.counter('rtmp_ffmpeg_exits_total', "ffmpeg exits by return code", ('code',))
+        self.m_reconnects = m.counter('rtmp_reconnects_total', "Reconnects after a failed ffmpeg process")
+        self.m_schedule_to_live = m.histogram('rtmp_schedule_to_live_seconds',
+                                              "Scheduled start to the first output packet of a stream")
+        self.m_first_packet = m.histogram('rtmp_time_to_first_packet_seconds',
+                                          "ffmpeg spawn to its first output packet")
+        self.m_active = m.gauge('rtmp_streams_active', "Registered streams by status", ('status',))
+        self.m_speed = m.gauge('rtmp_stream_encode_speed', "Latest encode speed per stream, 1.0 is realtime",
+                               ('stream',))
+        self.m_cpu = m.gauge('rtmp_stream_cpu_seconds', "CPU seconds used by a stream's current ffmpeg process",
+                             ('stream',))
+        m.add_collector(self._collect_metrics)
+    
+    def _collect_metrics(self):
+        """Refresh the gauges read from live streams, run on every scrape"""
+        streams = self.active_streams
+        counts = dict.fromkeys(TRANSITIONS, 0)
+        for state in streams.values():
+            counts[state.status] += 1
+        for status, count in counts.items():
+            self.m_active.set(count, status=status)
+        
+        # Rebuilt from scratch so finished streams drop out
+        self.m_speed.clear()
+        self.m_cpu.clear()
+        for stream_id, state in streams.items():
+            speed = state.progress.latest().get('speed')
+            if speed is not None:
+                self.m_speed.set(speed, stream=stream_id)
+            cpu = process_cpu_seconds(state.process.pid) if state.process else None
+            if cpu is not None:
+                self.m_cpu.set(cpu, stream=stream_id)
+    
+    def _event(self, event, stream_id, **fields):
+        """Write one structured event, if an event log is configured"""
+        if self.events:
+            self.events.emit(event, stream_id=stream_id, **fields)
+    
+    def _on_first_packet(self, state, spawned_at):
+        """ProgressTracker callback for the first output of an ffmpeg attempt"""
+        now = time.time()
+        self.m_first_packet.observe(now - spawned_at)
+        if not state.live:
+            state.live = True
+            self.m_schedule_to_live.observe(max(now - state.scheduled_at, 0))
+        self._event('first_packet', state.stream_id, after=round(now - spawned_at, 3),
+                    since_scheduled=round(now - state.scheduled_at, 3))
+    
+    def _finished(self, state):
+        """Account for a stream leaving the engine"""
+        if self.journal:
+            self.journal.remove(state.stream_id)
+        self.m_finished.inc(status=state.status)
+        self._event('stream_finished', state.stream_id, status=state.status, reconnects=state.reconnects,
+                    downtime=round(state.downtime, 3))
+    
+    def _settle(self, state, on_complete):
+        """Run a finished stream's completion callback with its final status, then resolve its completion future"""
+        try:
+            if on_complete:
+                on_complete(state.stream_id, self._status_with_metrics(state))
+        except Exception as e:
+            logger.error(f"Completion callback of stream {state.stream_id} failed: {str(e)}")
+        finally:
+            if not state.done.done():
+                state.done.set_result(state.status)
+    
+    def _off_loop(self, function, *args):
+        """Run blocking work in an executor when called on the event loop, so it never delays other streams"""
+        if self.loop and threading.current_thread() is self.loop_thread:
+            self.loop.run_in_executor(None, function, *args)
+        else:
+            function(*args)
+    
+    def _heartbeat(self):
+        """Thread function keeping the run journal's mtime current"""
+        while True:
+            time.sleep(JOURNAL_HEARTBEAT)
+            self.journal.heartbeat()
+    
+    def _sample_cost(self):
+        """Thread function feeding the CPU use of running encodes to admission control"""
+        while True:
+            time.sleep(COST_SAMPLE_INTERVAL)
+            self.admission.sample_cost([
+                state.process.pid for state in self.active_streams.values()
+                if state.process and not state.options.get('copy')
+            ])
+    
     def check_ffmpeg(self):
         """Check if ffmpeg is available and return True if it is"""
-        try:
-            result = subprocess.run(['ffmpeg', '-version'], 
-                                   stdout=subprocess.PIPE, 
-                                   stderr=subprocess.PIPE, 
-                                   text=True, 
-                                   check=True)
-            logger.info("FFmpeg found, version: " + result.stdout.split('\n')[0])
-            return True
-        except (subprocess.SubprocessError, FileNotFoundError) as e:
-            logger.error(f"FFmpeg check failed: {str(e)}")
+        version = self.capabilities.version
+        if version is None:
+            logger.error("FFmpeg check failed: no runnable ffmpeg on PATH")
             return False
+        logger.info("FFmpeg found, version: " + version)
+        return True
     
-    def start_stream(self, stream_id, video_path, streaming_key, duration, on_complete=None):
-        """Start streaming a video file to YouTube using RTMP protocol"""
+    def start_stream(self, stream_id, video_path, streaming_key, duration, on_complete=None, priority=0,
+                     profile=None, scheduled_at=None, start_at=None, fill=None, tag=None, offset=0.0):
+        """Start streaming a video file to YouTube using RTMP protocol
+        
+        With start_at (epoch seconds) in the future the stream is pre-rolled:
+        ffmpeg is started and connected now, pushes a slate and switches to
+        the content exactly at start_at. Stream-copied sources cannot have a
+        slate spliced in front, they are fully prepared and held until then.
+        
+        fill (one of FILL_POLICIES) covers the rest of the slot when the video
+        is shorter than duration: 'loop' repeats it, 'filler' chains the
+        filler clip after it. Either way one ffmpeg process and one RTMP
+        session run for exactly the slot duration.
+        
+        tag is any JSON value kept in the run journal and handed back by
+        recover(), e.g. the schedule slots the stream airs. offset starts
+        the video that many seconds in, to take over a slot already on air.
+        
+        on_complete(stream_id, final) is called once the stream has left the
+        engine; final is its last get_stream_status(with_metrics=True), whose
+        'status' tells a completed stream from a failed or stopped one.
+        """
         if not os.path.exists(video_path):
             logger.error(f"Video file not found: {video_path}")
             return False
         
+        if fill not in (None, *FILL_POLICIES):
+            logger.error(f"Unknown fill policy: {fill}")
+            return False
+        
+        options = {'profile_name': profile, 'scheduled_at': scheduled_at, 'start_at': start_at,
+                   'fill': fill or 'none', 'tag': tag}
+        if offset:
+            options['resume_offset'] = offset
+        return self._launch(stream_id, video_path, streaming_key, duration, on_complete, options, priority)
+    
+    def start_playlist(self, stream_id, items, streaming_key, on_complete=None, priority=0, profile=None,
+                       scheduled_at=None, start_at=None, tag=None):
+        """Stream several videos back to back over one ffmpeg process and RTMP session
+        
+        items is a list of (video_path, duration) tuples. Each video is cut at
+        its duration and followed by the next one without restarting the
+        encoder or reconnecting to ingest. Videos should share codec layout;
+        when all of them are in the media cache they are stream-copied.
+        start_at pre-rolls the playlist and tag is journaled like start_stream().
+        """
+        for video_path, _ in items:
+            if not os.path.exists(video_path):
+                logger.error(f"Video file not found: {video_path}")
+                return False
+        
+        use_cache = self.media_cache and (profile or 'auto') in ('auto', 'copy')
+        cached = [self.media_cache.lookup(path) if use_cache else None for path, _ in items]
+        copy = bool(items) and all(cached)
+        sources = cached if copy else [path for path, _ in items]
+        durations = [duration for _, duration in items]
+        
+        playlist_path = self._write_playlist(stream_id, list(zip(sources, durations)))
+        options = {'input_format': 'concat', 'copy': copy, 'playlist': items, 'profile_name': profile,
+                   'scheduled_at': scheduled_at, 'start_at': start_at, 'tag': tag}
+        return self._launch(stream_id, playlist_path, streaming_key, sum(durations), on_complete, options, priority)
+    
+    def _write_playlist(self, name, entries):
+        """Write an ffconcat playlist cutting each entry at its duration (None plays it to the end)"""
+        os.makedirs(PLAYLIST_DIR, exist_ok=True)
+        playlist_path = os.path.join(PLAYLIST_DIR, f"{name}.ffconcat")
+        with open(playlist_path, 'w') as f:
+            f.write("ffconcat version 1.0\n")
+            for path, duration in entries:
+                quoted = os.path.abspath(path).replace("'", "'\\''")
+                f.write(f"file '{quoted}'\n")
+                if duration is not None:
+                    f.write(f"outpoint {duration}\n")
+        return playlist_path
+    
+    def _splice_format(self, encoder, info=None):
+        """Output size, frame rate and audio of an encode that has a slate or filler spliced into it"""
+        height = encoder.get('height') or (info or {}).get('height') or 720
+        if info and info.get('width') and info.get('height'):
+            width = round(info['width'] * height / info['height'] / 2) * 2
+        else:
+            width = round(height * 16 / 9 / 2) * 2
+        fps = round(encoder.get('fps') or (info or {}).get('fps') or 30, 3)
+        # A silent source airs silent, splicing must not add a track it lacks
+        audio = not info or bool(info.get('audio_codec'))
+        return {'width': width, 'height': height, 'fps': fps, 'audio': audio}
+    
+    def _prepare_preroll(self, stream_id, options, info=None):
+        """Plan the slate pushed by a stream that starts at a future gate"""
+        start_at = options.get('start_at')
+        if not start_at or start_at <= time.time() or options['copy']:
+            return
+        options['slate'] = True
+        logger.info(f"Stream {stream_id} pre-rolling {start_at - time.time():.1f}s ahead of its start")
+    
+    def _prepare_fill(self, stream_id, options, info=None):
+        """Resolve the fill policy of a stream against its source"""
+        if options.get('fill', 'none') == 'none':
+            return
+        options['source_duration'] = (info or {}).get('duration')
+        if options['fill'] == 'filler' and options['copy']:
+            # A filler clip cannot be spliced into a stream copy
+            logger.warning(f"Stream {stream_id} is stream-copied, looping instead of chaining a filler")
+            options['fill'] = 'loop'
+        if options['fill'] != 'filler':
+            return
+        
+        filler_info = self.probe.probe(self.filler_path) if self.filler_path and self.probe else None
+        # Without a usable filler clip the slot is filled with black
+        if filler_info and filler_info.get('duration'):
+            options['filler'] = {
+                'path': self.filler_path,
+                'duration': filler_info['duration'],
+                'audio': bool(filler_info.get('audio_codec'))
+            }
+        else:
+            options['filler'] = None
+    
+    def _gate_lead(self, options):
+        """Seconds left until a pre-rolled stream's start gate, 0 without one"""
+        start_at = options.get('start_at')
+        return max(start_at - time.time(), 0.0) if start_at else 0.0
+    
+    def _launch(self, stream_id, video_path, streaming_key, duration, on_complete, options, priority=0):
+        """Resolve a new stream's encode plan and input, then enqueue it"""
         if stream_id in self.active_streams:
             logger.warning(f"Stream {stream_id} is already active")
             return False
         
+        if options.get('profile_name') not in (None, *profile_names()):
+            # Rejected like an unknown fill policy, plan_encode() would raise
+            logger.error(f"Unknown encoder profile: {options['profile_name']}")
+            return False
+        
         if not self.ffmpeg_available:
             logger.error("FFmpeg is not available. Cannot start actual streaming.")
             return False
         
-        thread = threading.Thread(
-            target=self._stream_thread,
-            args=(stream_id, video_path, streaming_key, duration, on_complete),
-            daemon=True
+        info = None
+        if options.get('input_format') == 'concat':
+            # Playlist inputs were already resolved against the cache
+            options['input_path'] = video_path
+            # The first item sets the format a slate in front of the playlist is conformed to
+            playlist = options['playlist']
+            info = self.probe.probe(playlist[0][0]) if self.probe and playlist else None
+            if options['copy']:
+                options['profile'] = {'name': 'cache', 'copy': True}
+            else:
+                options['profile'] = plan_encode(options['profile_name'])
+        else:
+            profile_name = options.get('profile_name') or 'auto'
+            # A pre-encoded mezzanine skips the encoder entirely, unless a specific profile was requested
+            use_cache = self.media_cache and profile_name in ('auto', 'copy')
+            cached_path = self.media_cache.lookup(video_path) if use_cache else None
+            # Probed even when cached: results are indexed, and fill needs the duration
+            info = self.probe.probe(video_path) if self.probe else None
+            plan = {'name': 'cache', 'copy': True} if cached_path else plan_encode(profile_name, info)
+            if cached_path:
+                logger.info(f"Stream {stream_id} using pre-encoded {cached_path} (stream copy)")
+            elif plan['copy']:
+                logger.info(f"Stream {stream_id} source is RTMP compliant, streaming {video_path} with copy")
+            else:
+                logger.info(f"Stream {stream_id} encoding with profile {plan['name']} "
+                            f"(scale: {plan['scale']}, fps conversion: {plan['convert_fps']}, {plan['maxrate']})")
+            options['input_path'] = cached_path or video_path
+            options['copy'] = plan['copy']
+            options['profile'] = plan
+        missing = self.capabilities.missing(options['copy'], self._resolve_outputs(streaming_key))
+        if missing:
+            # Fail now rather than burn every reconnect attempt on the same error
+            logger.error(f"Stream {stream_id} needs {', '.join(missing)}, which this ffmpeg lacks")
+            return False
+        # What encoder overrides are clamped to and a slate or filler is conformed to
+        options['source'] = {key: info.get(key) for key in ('width', 'height', 'fps', 'audio_codec')} if info else None
+        self._prepare_fill(stream_id, options, info)
+        self._prepare_preroll(stream_id, options, info)
+        return self._enqueue(stream_id, video_path, streaming_key, duration, on_complete, options, priority)
+    
+    def _enqueue(self, stream_id, video_path, streaming_key, duration, on_complete, options, priority=0):
+        """Register a resolved stream and hand it to the supervisor, via admission control if enabled"""
+        state = StreamState(
+            stream_id,
+            'queued' if self.admission else 'initializing',
+            self._resolve_outputs(streaming_key),
+            options
         )
+        state.on_complete = on_complete
+        # Enough to start the stream again; the deadline is refined on every spawn
+        entry = dict(video_path=video_path, streaming_key=streaming_key, pid=None,
+                     deadline=max(options.get('start_at') or 0, time.time()) + duration, options=options)
+        if not self._register(state, entry):
+            # Lost a race with a concurrent start of the same id
+            logger.warning(f"Stream {stream_id} is already active")
+            return False
+        self.m_started.inc()
+        self._event('stream_registered', stream_id, status=state.status, profile=options['profile']['name'],
+                    outputs=len(state.outputs))
         
-        self.active_streams[stream_id] = {
-            'thread': thread,
-            'start_time': datetime.now(),
-            'status': 'initializing',
-            'process': None
-        }
+        args = (stream_id, video_path, streaming_key, duration, on_complete, options)
+        if not self.admission:
+            self._supervise(state, video_path, streaming_key, duration, on_complete, options)
+            return True
         
-        thread.start()
+        def start(overrides, waited):
+            self._admitted(*args, overrides, waited)
+        
+        self.admission.request(stream_id, start, priority=priority, copy=options['copy'])
         return True
     
-    def _stream_thread(self, stream_id, video_path, streaming_key, duration, on_complete):
-        """Thread function that handles the actual streaming process"""
-        logger.info(f"Starting stream {stream_id} with video {video_path}")
+    def _admitted(self, stream_id, video_path, streaming_key, duration, on_complete, options, overrides, waited):
+        """Admission callback that starts a stream once it holds an encode slot"""
+        state = self.active_streams.get(stream_id)
         
-        try:
-            rtmp_url = f"rtmp://a.rtmp.youtube.com/live2/{streaming_key}"
-            
+        # Time spent queued comes out of the slot, the stream still ends on schedule;
+        # waiting during a pre-roll costs nothing, only time past the gate does
+        lost = waited
+        if options.get('start_at'):
+            lost = max(0.0, min(waited, time.time() - options['start_at']))
+        remaining = duration - lost
+        if remaining <= 0 and state and state.transition('completed', expected='queued'):
+            logger.warning(f"Stream {stream_id} expired after waiting {waited:.0f}s for an encode slot")
+            self._unregister(stream_id, state)
+            self._finished(state)
+            self._release(stream_id)
+            self._off_loop(self._settle, state, on_complete)
+            return
+        
+        if not state or not state.transition('initializing', expected='queued'):
+            # Stopped while it was waiting for a slot
+            self._release(stream_id)
+            return
+        
+        self._event('stream_admitted', stream_id, waited=round(waited, 3), overrides=overrides)
+        if overrides:
+            logger.info(f"Stream {stream_id} admitted under load with encoder overrides {overrides}")
+        options['encoder'] = overrides
+        self._supervise(state, video_path, streaming_key, remaining, on_complete, options)
+    
+    def _supervise(self, state, video_path, streaming_key, duration, on_complete, options):
+        """Hand a registered stream to the thread or asyncio supervisor
+        
+        The supervisor gets the state itself, so one stopped before it runs
+        still leaves the engine through it and settles its completion.
+        """
+        args = (state, video_path, streaming_key, duration, on_complete, options)
+        if self.resources:
+            options['cores'] = self.resources.place(state.stream_id, copy=options['copy'])
+        if self.mode == 'async':
+            state.task = asyncio.run_coroutine_threadsafe(self._stream_task(*args), self.loop)
+            return
+        
+        state.thread = threading.Thread(target=self._stream_thread, args=args, daemon=True)
+        state.thread.start()
+    
+    def _register(self, state, entry=None):
+        """Atomically add a stream to the registry; False if its id is taken
+        
+        entry is journaled under the registry lock, so a stop racing the start
+        always removes the journal entry after it was written, never before.
+        """
+        with self.registry_lock:
+            if state.stream_id in self.active_streams:
+                return False
+            streams = dict(self.active_streams)
+            streams[state.stream_id] = state
+            self.active_streams = streams
+            if self.journal and entry is not None:
+                self.journal.record(state.stream_id, **entry)
+            return True
+    
+    def _unregister(self, stream_id, state=None):
+        """Atomically remove a stream, only if it is still `state` when given; returns the removed state"""
+        with self.registry_lock:
+            current = self.active_streams.get(stream_id)
+            if current is None or (state is not None and current is not state):
+                return None
+            streams = dict(self.active_streams)
+            del streams[stream_id]
+            self.active_streams = streams
+            return current
+    
+    def _release(self, stream_id):
+        """Give a finished stream's encode slot and cores back"""
+        if self.resources:
+            self.resources.release(stream_id)
+        if self.admission:
+            self.admission.release(stream_id)
+    
+    def _resolve_outputs(self, streaming_key):
+        """Turn one streaming key/RTMP URL, or a list of them, into output URLs"""
+        keys = [streaming_key] if isinstance(streaming_key, str) else list(streaming_key)
+        urls = []
+        for key in keys:
+            if key.startswith(('rtmp://', 'rtmps://')):
+                urls.append(key)
+            else:
+                urls.append(f"{self.ingest_url}/{key}")
+        return urls
+    
+    def _resolve_command(self, streaming_key, options, offset=0.0, lead=0.0, remaining=None):
+        """Build the ffmpeg command for a stream from its resolved options
+        
+        A lead (seconds to the start gate) puts a black slate in front of the
+        content and the 'filler' policy a filler clip after it, spliced in one
+        ffmpeg process and one RTMP session. remaining is the time left in
+        the slot (from now, lead included), the exact cut-off of fill policies.
+        """
+        encoder = self._encoder_for(options)
+        if self.resources:
+            # Size the encoder's thread pool to the cores the stream is pinned to
+            encoder['threads'] = self.resources.threads_for(options.get('cores') or [])
+        fill = options.get('fill', 'none')
+        source_duration = options.get('source_duration')
+        limit = remaining if fill != 'none' else None
+        
+        if fill == 'loop' and source_duration:
+            # Resume at the same position within the looped video
+            offset %= source_duration
+        
+        if lead > 0 or fill == 'filler':
+            splice = self._splice_format(encoder, options.get('source'))
+            return self._build_splice_command(options, splice, self._resolve_outputs(streaming_key), encoder, offset,
+                                              lead, limit)
+        return self._build_command(
+            options['input_path'],
+            self._resolve_outputs(streaming_key),
+            copy=options['copy'],
+            input_format=options.get('input_format'),
+            encoder=encoder,
+            seek=offset,
+            loop=fill == 'loop',
+            limit=limit
+        )
+    
+    def _encoder_for(self, options):
+        """Encoder settings of a stream: its profile, with admission control's load overrides on top
+        
+        Overrides exist to make an encode cheaper, so they are clamped to the
+        profile and the source: never a larger picture, a higher bitrate or a
+        slower preset than the stream would have had without them.
+        """
+        encoder = dict(options.get('profile') or {})
+        # A profile without a height keeps the source size
+        height = encoder.get('height') or (options.get('source') or {}).get('height')
+        for key, value in (options.get('encoder') or {}).items():
+            if key == 'height' and height:
+                value = min(value, height)
+            elif key in ('maxrate', 'bufsize') and encoder.get(key):
+                value = min(value, encoder[key], key=lambda rate: int(rate.rstrip('k')))
+            elif key == 'preset' and encoder.get('preset') in X264_PRESETS:
+                value = min(value, encoder['preset'], key=X264_PRESETS.index)
+            encoder[key] = value
+        return encoder
+    
+    def _build_command(self, input_path, rtmp_urls, copy=False, input_format=None, encoder=None, seek=0.0,
+                       loop=False, limit=None):
+        """Build the ffmpeg command pushing input_path to one or more RTMP URLs
+        
+        loop repeats the input endlessly and limit cuts the output after that
+        many seconds, which together fill a slot longer than its video.
+        
+        encoder may override 'preset', 'maxrate', 'bufsize', 'height', 'gop',
+        'fps', 'threads' and 'audio_bitrate' of the live encode, e.g. from an
+        encoder profile or when admission control degrades it under load.
+        """
+        encoder = encoder or {}
+        command = [
+            'ffmpeg',
+            '-nostats',  # No \r status line on stderr
+            '-progress', 'pipe:1',  # Machine readable key=value progress on stdout
+            '-re'  # Read input at native frame rate
+        ]
+        if seek > 0:
+            # Resume point after a reconnect, input seeking is fast and frame accurate enough
+            command += ['-ss', f"{seek:.3f}"]
+        if loop:
+            command += ['-stream_loop', '-1']
+        if input_format == 'concat':
+            command += ['-f', 'concat', '-safe', '0']
+        command += ['-i', input_path]
+        
+        if copy:
+            # Input is already FLV/H.264 compliant, just remux it in real time
+            command += ['-c', 'copy']
+        else:
             # FFmpeg command with improved streaming parameters
-            command = [
-                'ffmpeg',
-                '-re',  # Read input at native frame rate
-                '-i', video_path,
-                '-c:v', 'libx264',  # Video codec
-                '-preset', 'veryfast',  # Encoding preset
-                '-tune', 'zerolatency',  # Tune for streaming
-                '-maxrate', '4500k',  # Maximum bitrate
-                '-bufsize', '9000k',  # Buffer size (2x maxrate)
-                '-pix_fmt', 'yuv420p',  # Pixel format
-                '-g', '60',  # Keyframe interval
-                '-c:a', 'aac',  # Audio codec
-                '-b:a', '160k',  # Audio bitrate
-                '-ac', '2',  # Audio channels
-                '-ar', '44100',  # Audio sample rate
+            if encoder.get('height'):
+                command += ['-vf', f"scale=-2:{encoder['height']}"]
+            if encoder.get('fps'):
+                command += ['-r', str(encoder['fps'])]
+            command += self._encoder_args(encoder)
+        return command + self._output_args(rtmp_urls, copy, limit, ['0:v?', '0:a?'])
+    
+    def _build_splice_command(self, options, splice, rtmp_urls, encoder, offset, lead, limit):
+        """Build the ffmpeg command splicing a slate, the content and a filler in a filtergraph
+        
+        Every part is a separate input with its own decoder, conformed to the
+        stream's splice format before the concat filter joins them, so parts
+        with different codecs, sizes or audio rates air as one encode. Inputs
+        that start one after another cannot be paced with -re, the realtime
+        filters pace the joined output instead.
+        """
+        width, height, fps = splice['width'], splice['height'], splice['fps']
+        fill = options.get('fill')
+        source_duration = options.get('source_duration')
+        filler = options.get('filler')
+        # Input arguments of each part in airing order, and whether the input carries audio
+        parts = []
+        if lead > 0:
+            parts.append((self._black_input(width, height, fps, lead), True))
+        
+        # A reconnect after the video ended resumes inside the filler
+        filling = fill == 'filler' and source_duration and offset >= source_duration
+        if not filling:
+            content = []
+            if offset > 0:
+                # Resume point after a reconnect
+                content += ['-ss', f"{offset:.3f}"]
+            if fill == 'loop':
+                content += ['-stream_loop', '-1']
+            if options.get('input_format') == 'concat':
+                content += ['-f', 'concat', '-safe', '0']
+            parts.append((content + ['-i', options['input_path']], True))
+        
+        if fill == 'filler' and filler:
+            # The filler repeats until -t ends the slot
+            seek = ['-ss', f"{(offset - source_duration) % filler['duration']:.3f}"] if filling else []
+            parts.append((['-stream_loop', '-1'] + seek + ['-i', filler['path']], filler['audio']))
+        elif fill == 'filler':
+            parts.append((self._black_input(width, height, fps), True))
+        
+        graph = []
+        joined = ''
+        for index, (_, audio) in enumerate(parts):
+            graph.append(f"[{index}:v]scale={width}:{height}:force_original_aspect_ratio=decrease,"
+                         f"pad={width}:{height}:-1:-1,setsar=1,fps={fps},format=yuv420p[v{index}]")
+            joined += f"[v{index}]"
+            if splice['audio']:
+                # A silent filler gets generated silence, concat needs audio in every segment
+                graph.append(f"[{index}:a]{SPLICE_AUDIO}[a{index}]" if audio else f"anullsrc=r=44100:cl=stereo[a{index}]")
+                joined += f"[a{index}]"
+        if splice['audio']:
+            graph.append(f"{joined}concat=n={len(parts)}:v=1:a=1[vj][aj]")
+            graph += ["[vj]realtime[v]", "[aj]arealtime[a]"]
+        else:
+            graph.append(f"{joined}concat=n={len(parts)}:v=1:a=0[vj]")
+            graph.append("[vj]realtime[v]")
+        
+        command = ['ffmpeg', '-nostats', '-progress', 'pipe:1']
+        for part, _ in parts:
+            command += part
+        command += ['-filter_complex', ';'.join(graph)] + self._encoder_args(encoder)
+        return command + self._output_args(rtmp_urls, False, limit, ['[v]', '[a]'] if splice['audio'] else ['[v]'])
+    
+    def _black_input(self, width, height, fps, duration=None):
+        """Input arguments of a generated black, silent clip, endless without a duration"""
+        video = f"color=c=black:s={width}x{height}:r={fps}"
+        audio = "anullsrc=r=44100:cl=stereo"
+        if duration is not None:
+            video += f":d={duration:.3f}"
+            audio += f",atrim=duration={duration:.3f}"
+        return ['-f', 'lavfi', '-i', f"{video}[out0];{audio}[out1]"]
+    
+    def _encoder_args(self, encoder):
+        """Encoder arguments of the live encode"""
+        args = [
+            '-c:v', 'libx264',  # Video codec
+            '-preset', encoder.get('preset', 'veryfast'),  # Encoding preset
+            '-tune', 'zerolatency',  # Tune for streaming
+            '-maxrate', encoder.get('maxrate', '4500k'),  # Maximum bitrate
+            '-bufsize', encoder.get('bufsize', '9000k'),  # Buffer size (2x maxrate)
+            '-pix_fmt', 'yuv420p',  # Pixel format
+            '-g', str(encoder.get('gop', 60)),  # Keyframe interval
+            '-c:a', 'aac',  # Audio codec
+            '-b:a', encoder.get('audio_bitrate', '160k'),  # Audio bitrate
+            '-ac', '2',  # Audio channels
+            '-ar', '44100'  # Audio sample rate
+        ]
+        if encoder.get('threads'):
+            args += ['-threads', str(encoder['threads'])]  # Encoder thread cap
+        return args
+    
+    def _output_args(self, rtmp_urls, copy, limit, maps):
+        """Output arguments pushing the mapped streams to one RTMP URL, or to several through the tee muxer"""
+        args = []
+        if limit is not None:
+            args += ['-t', f"{max(limit, 0):.3f}"]  # Exact end of the slot
+        
+        if len(rtmp_urls) == 1:
+            if maps[0].startswith('['):
+                # Filtergraph outputs are never picked up automatically
+                for stream in maps:
+                    args += ['-map', stream]
+            return args + [
                 '-f', 'flv',  # Output format
                 '-flvflags', 'no_duration_filesize',  # Important for live streaming
-                rtmp_url
+                rtmp_urls[0]
             ]
-            
-            # Update status to streaming
-            if stream_id in self.active_streams:
-                self.active_streams[stream_id]['status'] = 'connecting'
-            
-            # Start FFmpeg process
-            process = subprocess.Popen(
-                command,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                bufsize=1,
-                universal_newlines=True
-            )
-            
-            if stream_id in self.active_streams:
-                self.active_streams[stream_id]['process'] = process
-                self.active_streams[stream_id]['status'] = 'streaming'
-            
-            # Monitor the process
-            start_time = time.time()
-            while process.poll() is None:
-                if time.time() - start_time >= duration:
-                    # Gracefully stop the stream
-                    self.stop_stream(stream_id)
+        
+        # Encode once and fan out with the tee muxer; a failing destination is
+        # dropped (onfail=ignore) while the others keep streaming
+        slaves = '|'.join(
+            f"[f=flv:flvflags=no_duration_filesize:onfail=ignore]{url}" for url in rtmp_urls
+        )
+        if not copy:
+            # tee has no global header flag of its own, FLV needs the AVC/AAC config up front
+            args += ['-flags', '+global_header']
+        for stream in maps:
+            args += ['-map', stream]
+        return args + ['-f', 'tee', slaves]
+    
+    def _stream_thread(self, state, video_path, streaming_key, duration, on_complete, options):
+        """Thread function that handles the actual streaming process"""
+        stream_id = state.stream_id
+        logger.info(f"Starting stream {stream_id} with video {video_path}")
+        if not self._supervision_start(state, duration, options):
+            self._supervision_end(state, on_complete)
+            return
+        
+        try:
+            while self.active_streams.get(stream_id) is state:
+                self._pause(state, self._gate_hold(state))
+                command = self._attempt_command(state, streaming_key)
+                if command is None:
                     break
-                time.sleep(1)
-            
-            # Check process return code
-            if process.returncode == 0:
-                logger.info(f"Stream {stream_id} completed successfully")
-                if stream_id in self.active_streams:
-                    self.active_streams[stream_id]['status'] = 'completed'
-            else:
-                logger.error(f"Stream {stream_id} failed with return code {process.returncode}")
-                if stream_id in self.active_streams:
-                    self.active_streams[stream_id]['status'] = 'error'
-            
+                
+                # Start FFmpeg process
+                process = subprocess.Popen(
+                    command,
+                    # ffmpeg reads 'q' from stdin as a request to finish cleanly
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    start_new_session=self.journal is not None
+                )
+                tracker = self._attempt_started(state, process)
+                # Drain output continuously so a full pipe never blocks ffmpeg
+                threading.Thread(target=self._drain_output, args=(process, tracker), daemon=True).start()
+                
+                # Monitor the process
+                timed_out = False
+                while process.poll() is None:
+                    if time.time() >= state.deadline:
+                        # Gracefully stop the stream
+                        timed_out = True
+                        self._terminate(process)
+                        break
+                    if self.active_streams.get(stream_id) is not state:
+                        # Stopped by stop_stream(), which only asked ffmpeg to quit
+                        self._terminate(process)
+                        break
+                    self._pause(state, 1)
+                
+                delay = self._attempt_ended(state, process.returncode, timed_out)
+                if delay is None:
+                    break
+                # A stop during the backoff ends it at once
+                self._pause(state, delay)
+        
         except Exception as e:
             logger.error(f"Error in stream thread: {str(e)}")
-            if stream_id in self.active_streams:
-                self.active_streams[stream_id]['status'] = 'error'
+            state.transition('error')
         
         finally:
             # Cleanup
-            if stream_id in self.active_streams:
-                process = self.active_streams[stream_id].get('process')
-                if process and process.poll() is None:
-                    try:
-                        os.kill(process.pid, signal.SIGTERM)
-                        process.wait(timeout=5)
-                    except:
-                        try:
-                            os.kill(process.pid, signal.SIGKILL)
-                        except:
-                            pass
+            process = state.process
+            if process and process.poll() is None:
+                self._terminate(process)
+            self._supervision_end(state, on_complete)
+    
+    async def _stream_task(self, state, video_path, streaming_key, duration, on_complete, options):
+        """Coroutine that supervises one ffmpeg process on the shared event loop"""
+        stream_id = state.stream_id
+        logger.info(f"Starting stream {stream_id} with video {video_path}")
+        if not self._supervision_start(state, duration, options):
+            self._supervision_end(state, on_complete)
+            return
+        process = None
+        
+        try:
+            while self.active_streams.get(stream_id) is state:
+                await self._pause_async(state, self._gate_hold(state))
+                command = self._attempt_command(state, streaming_key)
+                if command is None:
+                    break
                 
-                del self.active_streams[stream_id]
+                process = await asyncio.create_subprocess_exec(
+                    *command,
+                    stdin=asyncio.subprocess.PIPE,
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.STDOUT,
+                    start_new_session=self.journal is not None
+                )
+                tracker = self._attempt_started(state, process)
+                self.loop.create_task(self._drain_output_async(process, tracker))
+                
+                # Enforce the duration with a loop timer instead of polling; a stop
+                # that came before the process existed ends the wait too
+                exited = asyncio.ensure_future(process.wait())
+                await asyncio.wait([exited, asyncio.wrap_future(state.stopping)],
+                                   timeout=max(state.deadline - time.time(), 0),
+                                   return_when=asyncio.FIRST_COMPLETED)
+                timed_out = not exited.done() and not state.stopping.done()
+                if not exited.done():
+                    await self._terminate_async(process)
+                
+                delay = self._attempt_ended(state, process.returncode, timed_out)
+                if delay is None:
+                    break
+                # A stop during the backoff ends it at once
+                await self._pause_async(state, delay)
+        
+        except Exception as e:
+            logger.error(f"Error in stream task: {str(e)}")
+            state.transition('error')
+        
+        finally:
+            if process and process.returncode is None:
+                await self._terminate_async(process)
+            self._supervision_end(state, on_complete)
+    
+    def _supervision_start(self, state, duration, options):
+        """Set up the slot of a stream whose supervisor starts; False if it was stopped before that"""
+        if self.active_streams.get(state.stream_id) is not state:
+            return False
+        # A pre-rolled stream's slot runs from its start gate
+        gate = max(options.get('start_at') or 0, time.time())
+        state.deadline = gate + duration
+        # Content position of a stream resumed after an engine restart
+        state.played = options.pop('resume_offset', 0.0)
+        if options.get('cut') is not None:
+            # Cut by cut_stream() before it got here
+            state.deadline = min(state.deadline, gate + options['cut'] - state.played)
+        return True
+    
+    def _pause(self, state, seconds):
+        """Sleep in a supervisor thread, waking early once the stream is stopped"""
+        if seconds > 0:
+            concurrent.futures.wait([state.stopping], timeout=seconds)
+    
+    async def _pause_async(self, state, seconds):
+        """Sleep in a supervisor coroutine, waking early once the stream is stopped"""
+        if seconds > 0:
+            await asyncio.wait([asyncio.wrap_future(state.stopping)], timeout=seconds)
+    
+    def _gate_hold(self, state):
+        """Seconds to hold at the start gate before spawning, for a stream with no slate to push meanwhile"""
+        lead = self._gate_lead(state.options)
+        if lead and not state.options.get('slate'):
+            # Nothing to push before the gate (stream copy), hold there fully prepared
+            logger.info(f"Stream {state.stream_id} holding {lead:.1f}s at the start gate")
+            return lead
+        return 0.0
+    
+    def _attempt_command(self, state, streaming_key):
+        """Build the next ffmpeg attempt's command and mark the stream connecting; None if it has to stop"""
+        if self.active_streams.get(state.stream_id) is not state:
+            # Stopped while holding at the gate
+            return None
+        if time.time() >= state.deadline:
+            # Cut short while waiting to reconnect
+            state.transition('completed')
+            return None
+        options = state.options
+        # Only a slate is pushed ahead of the gate
+        state.lead = self._gate_lead(options) if options.get('slate') else 0.0
+        command = self._resolve_command(streaming_key, options, state.played, state.lead,
+                                        state.deadline - time.time())
+        if not state.transition('connecting'):
+            return None
+        return command
+    
+    def _attempt_started(self, state, process):
+        """Account for a spawned ffmpeg attempt; returns the tracker its output is to be drained into"""
+        state.attempt_start = time.time()
+        if state.outage_start:
+            state.downtime += state.attempt_start - state.outage_start
+            state.outage_start = None
+        self._spawned(state, process)
+        
+        tracker = ProgressTracker(
+            on_first_sample=lambda _, spawned=state.attempt_start: self._on_first_packet(state, spawned)
+        )
+        state.progress = tracker
+        state.process = process
+        state.transition('streaming')
+        return tracker
+    
+    def _attempt_ended(self, state, returncode, timed_out):
+        """Decide what follows an ffmpeg exit; returns the delay before reconnecting, None once the stream is over"""
+        stream_id = state.stream_id
+        # An ffmpeg ended at a deadline moved by cut_stream() was not timed out by the supervisor
+        timed_out = timed_out or time.time() >= state.deadline
+        self._exited(state, returncode, timed_out)
+        
+        # Check process return code; a stopped ffmpeg quits cleanly with 0 too
+        if self.active_streams.get(stream_id) is not state:
+            # Stopped by stop_stream()
+            return None
+        if returncode == 0 or timed_out:
+            logger.info(f"Stream {stream_id} completed successfully")
+            state.transition('completed')
+            return None
+        
+        tracker = state.progress
+        logger.error(f"Stream {stream_id} failed with return code {returncode}: "
+                     + " | ".join(tracker.last_log_lines()[-3:]))
+        delay = self._reconnect_delay(state.reconnects, state.deadline)
+        if delay is None:
+            state.transition('error')
+            return None
+        
+        # Resume the input where the failed attempt left off, slate time excluded
+        played = tracker.latest().get('out_time') or (time.time() - state.attempt_start)
+        state.played += max(played - state.lead, 0.0)
+        state.outage_start = time.time()
+        state.reconnects += 1
+        if not state.transition('reconnecting'):
+            return None
+        self.m_reconnects.inc()
+        self._event('reconnecting', stream_id, attempt=state.reconnects, delay=delay, offset=round(state.played, 3))
+        logger.info(f"Reconnecting stream {stream_id} in {delay:.1f}s at offset {state.played:.1f}s")
+        return delay
+    
+    def _supervision_end(self, state, on_complete):
+        """Let a stream whose ffmpeg is gone leave the engine"""
+        self._unregister(state.stream_id, state)
+        self._finished(state)
+        
+        self._release(state.stream_id)
+        # Completion callbacks write to the schedule store
+        self._off_loop(self._settle, state, on_complete)
+    
+    def _spawned(self, state, process):
+        """Account for a new ffmpeg attempt"""
+        self.m_spawns.inc()
+        if self.resources:
+            # Forks ionice
+            self._off_loop(self.resources.apply, state.stream_id, process.pid)
+        if self.journal:
+            self.journal.record(state.stream_id, pid=process.pid, attempt_start=state.attempt_start,
+                                offset=state.played, lead=state.lead, deadline=state.deadline, options=state.options)
+        self._event('ffmpeg_spawned', state.stream_id, pid=process.pid, attempt=state.reconnects,
+                    offset=round(state.played, 3))
+    
+    def _exited(self, state, returncode, timed_out):
+        """Account for an ffmpeg attempt ending"""
+        self.m_exits.inc(code=returncode)
+        self._event('ffmpeg_exited', state.stream_id, code=returncode, timed_out=timed_out)
+    
+    def _reconnect_delay(self, reconnects, deadline):
+        """Return the backoff before the next reconnect, or None to give up"""
+        if not self.reconnect or reconnects >= self.reconnect.max_attempts:
+            return None
+        delay = self.reconnect.delay(reconnects)
+        if time.time() + delay >= deadline:
+            return None
+        return delay
+    
+    def _drain_output(self, process, tracker):
+        """Thread function feeding ffmpeg's merged stdout/stderr into a progress tracker
+        
+        Output is read as bytes and decoded leniently: ffmpeg echoes source
+        metadata in whatever encoding it has, and a drain that stops on it
+        leaves ffmpeg blocked on a full pipe.
+        """
+        try:
+            for line in process.stdout:
+                self._feed(tracker, line)
+        except (OSError, ValueError):
+            # The pipe was closed, ffmpeg is gone
+            pass
+    
+    async def _drain_output_async(self, process, tracker):
+        """Coroutine feeding ffmpeg's merged stdout/stderr into a progress tracker"""
+        while True:
+            try:
+                line = await process.stdout.readline()
+            except ValueError:
+                # A line longer than the reader limit was dropped, keep draining
+                continue
+            if not line:
+                break
+            self._feed(tracker, line)
+    
+    def _feed(self, tracker, line):
+        """Feed one raw output line to a tracker, never failing the drain"""
+        try:
+            tracker.feed_line(line.decode('utf-8', 'replace'))
+        except Exception as e:
+            logger.error(f"Cannot parse ffmpeg output line: {str(e)}")
+    
+    async def _terminate_async(self, process):
+        """Stop an asyncio ffmpeg child: 'q' on stdin, then SIGTERM, then SIGKILL, QUIT_GRACE apart"""
+        if process.returncode is not None:
+            return
+        try:
+            # 'q' lets ffmpeg flush and close its outputs like a normal end of input
+            process.stdin.write(b'q')
+            await process.stdin.drain()
+            await asyncio.wait_for(process.wait(), timeout=QUIT_GRACE)
+            return
+        except asyncio.TimeoutError:
+            logger.warning(f"FFmpeg {process.pid} ignored 'q', terminating it")
+        except (AttributeError, OSError):
+            # No stdin, or ffmpeg is already closing it
+            pass
+        try:
+            process.terminate()
+            await asyncio.wait_for(process.wait(), timeout=QUIT_GRACE)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+        except ProcessLookupError:
+            pass
+    
+    def recover(self, on_complete_for=None):
+        """Pick up the streams a previous engine run left in the run journal
+        
+        A stream whose ffmpeg is still running is re-adopted and stopped at
+        its deadline; one whose ffmpeg died with the old engine is started
+        again at the content position it had reached. Streams past their
+        deadline are dropped, along with any leftover ffmpeg.
+        on_complete_for(tag) returns the completion callback of a recovered
+        stream. Returns {stream_id: tag} of every stream that was handled.
+        """
+        if not self.journal:
+            return {}
+        if not self.ffmpeg_available:
+            logger.error("FFmpeg is not available. Cannot recover journaled streams.")
+            return {}
+        
+        recovered = {}
+        # The previous engine went away shortly after its last heartbeat
+        died_at = self.journal.last_seen or time.time()
+        for entry in self.journal.snapshot():
+            stream_id = entry['stream_id']
+            tag = entry['options'].get('tag')
+            on_complete = on_complete_for(tag) if on_complete_for else None
+            try:
+                running = self._still_running(entry)
+                if time.time() >= entry['deadline']:
+                    if running:
+                        self._terminate(AdoptedProcess(entry['pid']))
+                    logger.info(f"Stream {stream_id} reached its end while the engine was down")
+                    self.journal.remove(stream_id)
+                    if on_complete:
+                        on_complete(stream_id, {'status': 'completed'})
+                    handled = True
+                elif running:
+                    handled = self._adopt(entry, on_complete)
+                else:
+                    handled = self._resume(entry, on_complete, died_at)
+            except Exception as e:
+                logger.error(f"Cannot recover stream {stream_id}: {str(e)}")
+                handled = False
             
-            if on_complete:
-                on_complete(stream_id)
+            if handled:
+                recovered[stream_id] = tag
+            elif stream_id not in self.active_streams:
+                self.journal.remove(stream_id)
+        return recovered
+    
+    def _still_running(self, entry):
+        """True if a journaled pid still belongs to that stream's ffmpeg (pids get reused)"""
+        pid = entry.get('pid')
+        if not pid:
+            return False
+        if not os.path.isdir('/proc/self'):
+            # No command line to check without /proc, a live pid has to do
+            return AdoptedProcess(pid).poll() is None
+        try:
+            with open(f"/proc/{pid}/cmdline", 'rb') as f:
+                argv = f.read().decode('utf-8', 'replace').split('\0')
+        except OSError:
+            return False
+        outputs = self._resolve_outputs(entry['streaming_key'])
+        return (os.path.basename(argv[0]).startswith('ffmpeg')
+                and any(url in arg for url in outputs for arg in argv))
+    
+    def stop_orphans(self, streaming_key):
+        """Terminate ffmpeg processes on this host pushing to these outputs that no stream here owns
+        
+        Used before taking over a slot from a dead engine whose ffmpeg may
+        have outlived it; returns how many were stopped.
+        """
+        if not os.path.isdir('/proc/self'):
+            return 0
+        owned = {state.process.pid for state in self.active_streams.values() if state.process}
+        stopped = 0
+        for name in os.listdir('/proc'):
+            if not name.isdigit() or int(name) in owned or int(name) == os.getpid():
+                continue
+            if self._still_running({'pid': int(name), 'streaming_key': streaming_key}):
+                logger.warning(f"Stopping orphaned ffmpeg {name} still pushing to {streaming_key}")
+                self._terminate(AdoptedProcess(int(name)))
+                stopped += 1
+        return stopped
+    
+    def _resume(self, entry, on_complete, died_at):
+        """Start a journaled stream again where its last ffmpeg left off"""
+        stream_id = entry['stream_id']
+        options = entry['options']
+        deadline = entry['deadline']
+        if not os.path.exists(options['input_path']):
+            logger.error(f"Cannot resume stream {stream_id}, {options['input_path']} is gone")
+            return False
+        
+        if entry.get('pid'):
+            # -re keeps ffmpeg on the wall clock: it aired its runtime minus the slate
+            aired = min(died_at, deadline) - entry['attempt_start'] - entry.get('lead', 0.0)
+            options['resume_offset'] = entry['offset'] + max(aired, 0.0)
+        # The slot still ends at the journaled deadline, counted from the gate if that is ahead
+        duration = deadline - max(options.get('start_at') or 0, time.time())
+        
+        logger.info(f"Resuming stream {stream_id} at offset {options.get('resume_offset', 0.0):.1f}s "
+                    f"for {duration:.1f}s")
+        self._event('stream_resumed', stream_id, offset=round(options.get('resume_offset', 0.0), 3),
+                    remaining=round(duration, 3))
+        return self._enqueue(stream_id, entry['video_path'], entry['streaming_key'], duration, on_complete, options)
+    
+    def _adopt(self, entry, on_complete):
+        """Take over an ffmpeg left running by a previous engine run"""
+        stream_id = entry['stream_id']
+        options = entry['options']
+        state = StreamState(stream_id, 'connecting', self._resolve_outputs(entry['streaming_key']), options)
+        state.process = AdoptedProcess(entry['pid'], entry['attempt_start'])
+        state.played = entry['offset']
+        state.lead = entry.get('lead', 0.0)
+        state.deadline = entry['deadline']
+        state.attempt_start = entry['attempt_start']
+        # Went live before the restart, schedule-to-live is not observed again
+        state.live = True
+        state.transition('streaming')
+        # Bypasses admission control, the process already holds its CPU
+        if not self._register(state):
+            return False
+        
+        if self.resources:
+            options['cores'] = self.resources.place(stream_id, copy=options['copy'])
+            self.resources.apply(stream_id, entry['pid'])
+        logger.info(f"Re-adopted stream {stream_id} (ffmpeg pid {entry['pid']}), "
+                    f"{entry['deadline'] - time.time():.1f}s left")
+        self._event('stream_adopted', stream_id, pid=entry['pid'], remaining=round(entry['deadline'] - time.time(), 3))
+        
+        # Polled from a plain thread in either mode, there is no child to wait on
+        thread = threading.Thread(target=self._adopted_thread, args=(state, entry, on_complete), daemon=True)
+        state.thread = thread
+        thread.start()
+        return True
+    
+    def _adopted_thread(self, state, entry, on_complete):
+        """Thread function enforcing the deadline of an adopted ffmpeg"""
+        stream_id = state.stream_id
+        process = state.process
+        resumed = False
+        
+        try:
+            while self.active_streams.get(stream_id) is state:
+                if time.time() >= state.deadline:
+                    self._terminate(process)
+                    self._exited(state, 'unknown', True)
+                    logger.info(f"Stream {stream_id} completed successfully")
+                    state.transition('completed')
+                    break
+                if process.poll() is not None:
+                    # The exit code of a process we did not spawn is unknown, so
+                    # treat an early exit as a failure and carry on in a supervisor of our own
+                    self._exited(state, 'unknown', False)
+                    logger.warning(f"Adopted stream {stream_id} exited early, resuming it")
+                    self._unregister(stream_id, state)
+                    resumed = self._resume(entry, on_complete, time.time())
+                    if not resumed:
+                        state.transition('error')
+                    else:
+                        # Whoever waits on this stream now waits on its new supervisor
+                        successor = self.active_streams.get(stream_id)
+                        if successor:
+                            successor.done.add_done_callback(lambda future: state.done.set_result(future.result()))
+                        else:
+                            state.done.set_result(state.status)
+                    break
+                time.sleep(1)
+        
+        except Exception as e:
+            logger.error(f"Error in adopted stream thread: {str(e)}")
+            state.transition('error')
+        
+        finally:
+            if not resumed:
+                if process.poll() is None:
+                    self._terminate(process)
+                self._unregister(stream_id, state)
+                self._finished(state)
+                
+                self._release(stream_id)
+                self._settle(state, on_complete)
     
     def stop_stream(self, stream_id):
-        """Stop an active stream"""
-        if stream_id in self.active_streams:
-            logger.info(f"Stopping stream {stream_id}")
-            stream_data = self.active_streams[stream_id]
-            process = stream_data.get('process')
-            
-            if process and process.poll() is None:
-                try:
-                    # Try graceful termination first
-                    os.kill(process.pid, signal.SIGTERM)
-                    process.wait(timeout=5)
-                except:
-                    try:
-                        # Force kill if graceful termination fails
-                        os.kill(process.pid, signal.SIGKILL)
-                    except:
-                        pass
-            
-            del self.active_streams[stream_id]
+        """Ask an active stream to stop without waiting for it to exit
+        
+        ffmpeg is sent 'q' on stdin so it closes its outputs cleanly, and its
+        supervisor escalates to SIGTERM and SIGKILL if it does not exit in
+        time. Returns the stream's completion future (see completion()), or
+        False if the stream is not active.
+        """
+        # Unregister first so the supervisor treats the exit as deliberate;
+        # of several concurrent stops exactly one gets the state
+        state = self._unregister(stream_id)
+        if state is None:
+            return False
+        
+        logger.info(f"Stopping stream {stream_id}")
+        self._event('stop_requested', stream_id, status=state.status)
+        if state.transition('stopped', expected='queued'):
+            if self.admission:
+                self.admission.cancel(stream_id)
+            self._finished(state)
+            self._settle(state, state.on_complete)
+            return state.done
+        state.transition('stopped')
+        # A supervisor yet to run, or waiting at the gate, notices right away and settles the stream
+        state.stopping.set_result(None)
+        
+        process = state.process
+        if isinstance(process, AdoptedProcess):
+            # Its watcher thread notices within a second and terminates it
+            pass
+        elif self.mode == 'async':
+            # Woken by stopping, the supervisor coroutine terminates ffmpeg itself
+            pass
+        elif process:
+            # The supervisor thread escalates if ffmpeg ignores it
+            self._send_quit(process)
+        return state.done
+    
+    def stop_many(self, stream_ids):
+        """Stop several streams at once; returns {stream_id: completion future} of those that were active
+        
+        Every ffmpeg is asked to quit before any is waited on, so stopping a
+        hundred streams takes one grace period, not a hundred. Wait for a
+        clean shutdown with concurrent.futures.wait(futures.values(), timeout).
+        """
+        futures = {}
+        for stream_id in stream_ids:
+            future = self.stop_stream(stream_id)
+            if future:
+                futures[stream_id] = future
+        return futures
+    
+    def stop_all(self):
+        """Stop every active stream; see stop_many()"""
+        return self.stop_many(list(self.active_streams))
+    
+    def cut_stream(self, stream_id, position):
+        """End a stream once its content reaches position seconds, e.g. right before a playlist item
+        
+        The stream then completes as if its slot ended there. One that is
+        already past position is stopped now. Returns the completion future,
+        or False if the stream is not active.
+        """
+        state = self.active_streams.get(stream_id)
+        if state is None:
+            return False
+        left = position - self._status_with_metrics(state)['on_air']
+        if left <= 0:
+            return self.stop_stream(stream_id)
+        
+        logger.info(f"Cutting stream {stream_id} at {position:.1f}s of content, {left:.1f}s from now")
+        self._event('cut_requested', stream_id, position=round(position, 3))
+        # Picked up by a supervisor that has yet to set the deadline
+        state.options['cut'] = position
+        if state.deadline is None:
+            return state.done
+        # Content plays in real time from the start gate on
+        deadline = max(state.options.get('start_at') or 0, time.time()) + left
+        if deadline >= state.deadline:
+            return state.done
+        state.deadline = deadline
+        if self.journal:
+            self.journal.record(stream_id, deadline=deadline, options=state.options)
+        if self.mode == 'async' and not isinstance(state.process, AdoptedProcess):
+            # The supervisor's wait is timed for the old deadline
+            asyncio.run_coroutine_threadsafe(self._cut_async(state), self.loop)
+        return state.done
+    
+    async def _cut_async(self, state):
+        """Stop the ffmpeg of an asyncio-supervised stream at its moved deadline"""
+        await asyncio.sleep(max(state.deadline - time.time(), 0))
+        process = state.process
+        if (self.active_streams.get(state.stream_id) is state and process and process.returncode is None
+                and time.time() >= state.deadline):
+            await self._terminate_async(process)
+    
+    def completion(self, stream_id):
+        """Return the future resolved with a stream's final status once it has left the engine, or None
+        
+        Use add_done_callback() on it, block on result(timeout), or await
+        asyncio.wrap_future() of it from a coroutine.
+        """
+        state = self.active_streams.get(stream_id)
+        return state.done if state else None
+    
+    def _send_quit(self, process):
+        """Type 'q' into a Popen ffmpeg's stdin; False if there is no stdin to type into"""
+        stdin = getattr(process, 'stdin', None)
+        if stdin is None or process.poll() is not None:
+            return False
+        try:
+            stdin.write(b'q')
+            stdin.flush()
             return True
-        return False
+        except (OSError, ValueError):
+            # Broken or closed pipe, ffmpeg is already on its way out
+            return False
     
-    def get_stream_status(self, stream_id):
-        """Get the status of a stream"""
-        if stream_id in self.active_streams:
-            return self.active_streams[stream_id]['status']
-        return None
+    def _terminate(self, process):
+        """Stop a Popen ffmpeg child: 'q' on stdin, then SIGTERM, then SIGKILL, QUIT_GRACE apart"""
+        if self._send_quit(process):
+            try:
+                process.wait(timeout=QUIT_GRACE)
+                return
+            except subprocess.TimeoutExpired:
+                logger.warning(f"FFmpeg {process.pid} ignored 'q', terminating it")
+        try:
+            # Then ask the process to terminate
+            os.kill(process.pid, signal.SIGTERM)
+            process.wait(timeout=QUIT_GRACE)
+        except:
+            try:
+                # Force kill if graceful termination fails
+                os.kill(process.pid, signal.SIGKILL)
+            except:
+                pass
+    
+    def _status_with_metrics(self, state):
+        """Combine a stream's status with its latest ffmpeg progress sample"""
+        progress = state.progress
+        current = state.status
+        failed = progress.failed_outputs()
+        metrics = progress.latest()
+        out_time = metrics.get('out_time') or 0
+        if isinstance(state.process, AdoptedProcess):
+            # No progress pipe to an adopted ffmpeg, -re keeps its output on the wall clock
+            out_time = time.time() - state.process.started
+        status = {
+            'status': current,
+            'metrics': metrics,
+            'profile': state.options['profile']['name'],
+            'reconnects': state.reconnects,
+            'downtime': round(state.downtime, 3),
+            'preroll': round(self._gate_lead(state.options), 3),
+            'fill': state.options.get('fill', 'none'),
+            'adopted': isinstance(state.process, AdoptedProcess),
+            'outputs': [
+                {
+                    'target': mask_rtmp_url(url),
+                    'status': 'failed' if index in failed else current
+                }
+                for index, url in enumerate(state.outputs)
+            ]
+        }
+        
+        # Time on air counts content only, not the pre-roll slate
+        on_air = state.played + max(out_time - state.lead, 0)
+        status['on_air'] = round(on_air, 3)
+        source_duration = state.options.get('source_duration')
+        if source_duration and status['fill'] == 'loop':
+            status['loops'] = int(on_air // source_duration)
+        elif source_duration and status['fill'] == 'filler':
+            status['filling'] = on_air >= source_duration
+        
+        playlist = state.options.get('playlist')
+        if playlist:
+            # Locate the playing item from the content position
+            elapsed = on_air
+            index = 0
+            for index, (_, duration) in enumerate(playlist):
+                if elapsed < duration:
+                    break
+                elapsed -= duration
+            status['playlist_index'] = index
+        return status
+    
+    def get_stream_status(self, stream_id, with_metrics=False):
+        """Get the status of a stream, optionally with live encoder metrics"""
+        state = self.active_streams.get(stream_id)
+        if state is None:
+            return None
+        if with_metrics:
+            return self._status_with_metrics(state)
+        return state.status
     
-    def get_active_streams(self):
-        """Get all active streams"""
-        return {k: v['status'] for k, v in self.active_streams.items()}
+    def get_active_streams(self, with_metrics=False):
+        """Get all active streams, optionally with live encoder metrics"""
+        # The registry dict is never mutated in place, iterating it needs no lock
+        streams = self.active_streams
+        if with_metrics:
+            return {k: self._status_with_metrics(v) for k, v in streams.items()}
+        return {k: v.status for k, v in streams.items()}
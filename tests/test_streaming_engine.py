@@ -0,0 +1,116 @@
+import concurrent.futures
+import os
+import stat
+import sys
+import textwrap
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ffmpeg_caps import FFmpegCapabilities  # noqa: E402
+from admission import AdmissionController  # noqa: E402
+from run_journal import RunJournal  # noqa: E402
+from streaming_engine import ReconnectPolicy, RTMPStreamer  # noqa: E402
+
+# Stands in for ffmpeg: answers the capability probes, otherwise "streams" until
+# it reads 'q' on stdin or FAKE_FFMPEG_SECONDS pass, exiting with FAKE_FFMPEG_RC
+FAKE_FFMPEG = textwrap.dedent('''\
+    #!{python}
+    import os, sys, threading, time
+    args = sys.argv[1:]
+    if args == ['-version']:
+        print("ffmpeg version 6.0-fake")
+        sys.exit(0)
+    if args[:1] == ['-hide_banner']:
+        print({{
+            '-encoders': "Encoders:\\n ------\\n V..... libx264 H.264\\n A..... aac AAC\\n",
+            '-muxers': "File formats:\\n --\\n  E flv FLV\\n  E tee Tee\\n",
+            '-protocols': "Supported file protocols:\\nInput:\\n  file\\nOutput:\\n  rtmp\\n",
+        }}[args[1]])
+        sys.exit(0)
+
+    def read_keys():
+        while True:
+            key = sys.stdin.read(1)
+            if not key or key == 'q':
+                os._exit(0)
+
+    threading.Thread(target=read_keys, daemon=True).start()
+    time.sleep(float(os.environ.get('FAKE_FFMPEG_SECONDS', '60')))
+    sys.exit(int(os.environ.get('FAKE_FFMPEG_RC', '0')))
+''')
+
+
+@pytest.fixture
+def fake_ffmpeg(tmp_path, monkeypatch):
+    """Put the fake ffmpeg first on PATH and run from a scratch directory"""
+    bin_dir = tmp_path / 'bin'
+    bin_dir.mkdir()
+    binary = bin_dir / 'ffmpeg'
+    binary.write_text(FAKE_FFMPEG.format(python=sys.executable))
+    binary.chmod(binary.stat().st_mode | stat.S_IEXEC)
+    monkeypatch.setenv('PATH', f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'video.mp4').write_bytes(b'not a real video')
+    return FFmpegCapabilities('ffmpeg', str(tmp_path / 'ffmpeg_caps.json'))
+
+
+@pytest.mark.parametrize('mode', ['thread', 'async'])
+@pytest.mark.parametrize('admission', [False, True])
+def test_stop_right_after_start_settles_every_stream(fake_ffmpeg, mode, admission):
+    journal = RunJournal('run_journal.json')
+    streamer = RTMPStreamer(mode=mode, journal=journal, capabilities=fake_ffmpeg,
+                            admission=AdmissionController(max_encodes=4) if admission else None)
+    completed = []
+    lock = threading.Lock()
+
+    def on_complete(stream_id, final):
+        with lock:
+            completed.append(stream_id)
+
+    futures = []
+    for index in range(50):
+        assert streamer.start_stream(f"s{index}", 'video.mp4', 'key', 60, on_complete)
+        futures.append(streamer.stop_stream(f"s{index}"))
+
+    assert all(futures)
+    done, pending = concurrent.futures.wait(futures, timeout=30)
+    assert not pending
+    assert {future.result() for future in done} == {'stopped'}
+    assert sorted(completed) == sorted(f"s{index}" for index in range(50))
+    assert streamer.active_streams == {}
+    journal.flush()
+    assert journal.snapshot() == []
+    assert RunJournal('run_journal.json').snapshot() == []
+
+
+@pytest.mark.parametrize('mode', ['thread', 'async'])
+def test_stop_during_reconnect_backoff_resolves_at_once(fake_ffmpeg, mode, monkeypatch):
+    # Every attempt fails right away, the first backoff is 20s
+    monkeypatch.setenv('FAKE_FFMPEG_SECONDS', '0.2')
+    monkeypatch.setenv('FAKE_FFMPEG_RC', '1')
+    streamer = RTMPStreamer(mode=mode, capabilities=fake_ffmpeg,
+                            reconnect=ReconnectPolicy(base_delay=20.0, max_delay=20.0))
+    assert streamer.start_stream('s', 'video.mp4', 'key', 60)
+    for _ in range(100):
+        if streamer.get_stream_status('s') == 'reconnecting':
+            break
+        time.sleep(0.1)
+    assert streamer.get_stream_status('s') == 'reconnecting'
+
+    stopped_at = time.time()
+    future = streamer.stop_stream('s')
+    assert future.result(timeout=5) == 'stopped'
+    assert time.time() - stopped_at < 2
+
+
+@pytest.mark.parametrize('mode', ['thread', 'async'])
+def test_unknown_profile_is_rejected_like_an_unknown_fill(fake_ffmpeg, mode):
+    streamer = RTMPStreamer(mode=mode, capabilities=fake_ffmpeg)
+    assert streamer.start_stream('s', 'video.mp4', 'key', 60, profile='4k') is False
+    assert streamer.start_stream('s', 'video.mp4', 'key', 60, fill='forever') is False
+    assert streamer.start_playlist('p', [('video.mp4', 30)], 'key', profile='4k') is False
+    assert streamer.active_streams == {}
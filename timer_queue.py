@@ -0,0 +1,110 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+logger = logging.getLogger('timer_queue')
+
+
+def next_occurrence(jam_mulai, now=None):
+    """Return the datetime of the next "HH:MM" slot.
+
+    A slot whose minute is still in progress is due immediately, matching the
+    old minute-granularity polling; a slot that has already passed rolls over
+    to the same time tomorrow.
+    """
+    now = now or datetime.now()
+    hour, minute = map(int, jam_mulai.split(':'))
+    start = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if now >= start + timedelta(minutes=1):
+        start += timedelta(days=1)
+    return start
+
+
+class TimerQueue:
+    """Min-heap of absolute deadlines served by a single sleeping thread.
+
+    The worker sleeps exactly until the earliest deadline and is woken early
+    whenever a timer is added or cancelled. Scheduling and cancelling are
+    O(log n); cancelled entries are dropped lazily when they reach the top.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.entries = {}
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        """Start the timer thread"""
+        with self.cond:
+            if self.running:
+                return
+            self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop the timer thread; pending timers are kept"""
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+    def schedule(self, key, when, callback, *args):
+        """Run callback(*args) at `when` (datetime or epoch seconds), replacing any timer with the same key"""
+        deadline = when.timestamp() if isinstance(when, datetime) else float(when)
+        entry = [deadline, next(self.counter), key, callback, args]
+        with self.cond:
+            old = self.entries.pop(key, None)
+            if old:
+                old[3] = None
+            self.entries[key] = entry
+            heapq.heappush(self.heap, entry)
+            self.cond.notify()
+        return deadline
+
+    def cancel(self, key):
+        """Cancel the timer registered under key, returns True if one was pending"""
+        with self.cond:
+            entry = self.entries.pop(key, None)
+            if not entry:
+                return False
+            entry[3] = None
+            self.cond.notify()
+            return True
+
+    def pending(self):
+        """Return {key: deadline} for all pending timers"""
+        with self.cond:
+            return {key: entry[0] for key, entry in self.entries.items()}
+
+    def _run(self):
+        """Thread function sleeping until the next deadline and firing due timers"""
+        while True:
+            with self.cond:
+                while self.running:
+                    while self.heap and self.heap[0][3] is None:
+                        heapq.heappop(self.heap)
+                    if not self.heap:
+                        self.cond.wait()
+                        continue
+                    delay = self.heap[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self.cond.wait(delay)
+                if not self.running:
+                    return
+
+                entry = heapq.heappop(self.heap)
+                _, _, key, callback, args = entry
+                if self.entries.get(key) is entry:
+                    del self.entries[key]
+
+            try:
+                callback(*args)
+            except Exception as e:
+                logger.error(f"Timer {key} callback failed: {str(e)}")
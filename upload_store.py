@@ -0,0 +1,120 @@
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger('upload_store')
+
+# Uploads are copied and hashed in 1 MiB blocks so memory stays bounded
+CHUNK_SIZE = 1024 * 1024
+
+UPLOAD_ID = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+class UploadStore:
+    """Content-addressed store for uploaded videos.
+
+    Data is streamed to ``<upload_id>.part`` in chunks, so a partial upload
+    can be resumed from its current size. On finish the file is hashed and
+    renamed to ``<sha256><suffix>``; if that file already exists the upload
+    is a duplicate and the copy is dropped instead of written twice.
+    """
+
+    def __init__(self, upload_dir='uploads', chunk_size=CHUNK_SIZE):
+        self.upload_dir = upload_dir
+        self.chunk_size = chunk_size
+        self.lock = threading.Lock()
+        os.makedirs(self.upload_dir, exist_ok=True)
+
+    def _part_path(self, upload_id):
+        """Return the partial file path of an upload"""
+        if not UPLOAD_ID.match(upload_id or ''):
+            raise ValueError(f"Invalid upload id: {upload_id!r}")
+        return os.path.join(self.upload_dir, f"{upload_id}.part")
+
+    def offset(self, upload_id):
+        """Return how many bytes of an upload are already on disk"""
+        try:
+            return os.path.getsize(self._part_path(upload_id))
+        except OSError:
+            return 0
+
+    def write_chunk(self, upload_id, offset, data):
+        """Append a chunk at `offset`; returns the new size
+
+        A chunk that does not start at the current size is rejected so a
+        retried or reordered request can never corrupt the file.
+        """
+        part_path = self._part_path(upload_id)
+        with self.lock:
+            current = self.offset(upload_id)
+            if offset != current:
+                raise ValueError(f"Upload {upload_id} is at offset {current}, not {offset}")
+            with open(part_path, 'ab') as f:
+                f.write(data)
+            return current + len(data)
+
+    def finish(self, upload_id, suffix='.mp4'):
+        """Move a complete upload to its content-addressed path and return it"""
+        part_path = self._part_path(upload_id)
+        if not os.path.exists(part_path):
+            raise ValueError(f"Unknown upload {upload_id}")
+
+        sha = hashlib.sha256()
+        with open(part_path, 'rb') as f:
+            for block in iter(lambda: f.read(self.chunk_size), b''):
+                sha.update(block)
+        return self._commit(part_path, sha.hexdigest(), suffix)
+
+    def save_fileobj(self, fileobj, suffix='.mp4'):
+        """Copy a file object into the store chunk by chunk and return its path"""
+        fd, part_path = tempfile.mkstemp(suffix='.part', dir=self.upload_dir)
+        sha = hashlib.sha256()
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for block in iter(lambda: fileobj.read(self.chunk_size), b''):
+                    sha.update(block)
+                    f.write(block)
+        except OSError:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+            raise
+        return self._commit(part_path, sha.hexdigest(), suffix)
+
+    def _commit(self, part_path, digest, suffix):
+        """Rename a finished part file to its digest, dropping duplicates"""
+        if not re.match(r'^\.[A-Za-z0-9]{1,8}$', suffix or ''):
+            suffix = '.mp4'
+        final_path = os.path.abspath(os.path.join(self.upload_dir, f"{digest}{suffix.lower()}"))
+        with self.lock:
+            if os.path.exists(final_path):
+                os.remove(part_path)
+                # Touch it so orphan cleanup sees the file as fresh again
+                os.utime(final_path)
+                logger.info(f"Upload is a duplicate of {final_path}")
+            else:
+                os.replace(part_path, final_path)
+                logger.info(f"Stored upload as {final_path}")
+        return final_path
+
+    def cleanup(self, keep=(), max_age=24 * 3600):
+        """Delete stale part files and stored videos no slot refers to; returns the count removed"""
+        keep = {os.path.abspath(path) for path in keep}
+        cutoff = time.time() - max_age
+        removed = 0
+        with self.lock:
+            for name in os.listdir(self.upload_dir):
+                path = os.path.abspath(os.path.join(self.upload_dir, name))
+                try:
+                    if path in keep or os.path.getmtime(path) > cutoff:
+                        continue
+                    os.remove(path)
+                    removed += 1
+                except OSError as e:
+                    logger.error(f"Cannot remove orphaned upload {path}: {str(e)}")
+        if removed:
+            logger.info(f"Removed {removed} orphaned uploads")
+        return removed